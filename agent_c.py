@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 
+import asyncio
+import json
 import logging as log
+import threading
+import os
+import re
+import time
+import uuid
+from functools import cached_property
 from typing import Any, Dict, Optional, Union
 from pydantic import BaseModel, Field
 
 import langchain
-from langchain.agents import initialize_agent, AgentType, Tool
-from langchain.callbacks.stdout import StdOutCallbackHandler
+from langchain.agents import (
+    initialize_agent,
+    AgentType,
+    OpenAIMultiFunctionsAgent,
+    Tool,
+)
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.chains import LLMMathChain
 from langchain.chains.conversation.memory import ConversationBufferWindowMemory
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import MessagesPlaceholder
-from langchain.schema import get_buffer_string, AgentAction, SystemMessage
+from langchain.schema import (
+    get_buffer_string,
+    LLMResult,
+    messages_from_dict,
+    messages_to_dict,
+    AgentAction,
+    SystemMessage,
+)
 from langchain.tools import StructuredTool
 from langchain.utilities import (
     WikipediaAPIWrapper,
@@ -19,14 +39,17 @@ from langchain.utilities import (
     GoogleSearchAPIWrapper,
 )
 
-from tools.gnews import HeadlinesTool
-from tools.ytsubs import yt_transcript
-from tools.reader import ReaderTool
-from tools.genimg import genimg_raw, genimg_curated, img_prompt_chain
+import dispatcher
+import metrics
+from executors import ParallelAgentExecutor
+from memory import TokenBudgetMemory
+from tools import budget, cache, registry
+from tools.cache import DEFAULT_DB, TTLCache, normalize_key
 
 log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-langchain.debug = True
-# langchain.verbose = True
+# Full prompt dumps for every chain step; far too slow and noisy to leave on in production.
+langchain.debug = os.environ.get("AGENT_C_DEBUG", "") == "1"
+VERBOSE = os.environ.get("AGENT_C_VERBOSE", "") == "1"
 
 class SearchInput(BaseModel):
     query: str = Field(
@@ -38,8 +61,49 @@ class SearchInput(BaseModel):
     # )
 
 
-class SignalCallbackHandler(StdOutCallbackHandler):
-    """Callback Handler that sends updates back to signal."""
+class WikipediaInput(BaseModel):
+    query: str = Field(description="Topic to look up")
+    cursor: int = Field(
+        default=0,
+        description="Start reading the articles from this character. "
+        "Use when the first response was truncated and you want to continue reading.",
+    )
+
+
+search_cache = TTLCache(
+    "search",
+    ttl=float(os.environ.get("SEARCH_CACHE_TTL", "900")),
+    max_items=256,
+    path=DEFAULT_DB,
+)
+wikipedia_cache = TTLCache(
+    "wikipedia",
+    ttl=float(os.environ.get("WIKIPEDIA_CACHE_TTL", str(24 * 3600))),
+    max_items=256,
+    path=DEFAULT_DB,
+)
+
+# What WikipediaAPIWrapper returns when a search finds nothing. Not cached, as that is
+# as likely to be a flaky search as a missing article.
+NO_WIKIPEDIA_RESULT = "No good Wikipedia Search Result was found"
+
+
+def found_articles(articles):
+    return not articles.startswith(NO_WIKIPEDIA_RESULT)
+
+
+class WikipediaArticles(WikipediaAPIWrapper):
+    """WikipediaAPIWrapper that returns the articles found rather than their summaries.
+    Each of the `top_k_results` articles gets an equal share of `doc_content_chars_max`."""
+
+    def _formatted_page_summary(self, page_title: str, wiki_page: Any) -> Optional[str]:
+        share = self.doc_content_chars_max // self.top_k_results
+        return f"Page: {page_title}\n{wiki_page.content}"[:share]
+
+
+class SignalCallbackHandler(BaseCallbackHandler):
+    """Callback Handler that sends updates back to signal. Chain and tool output is
+    only echoed to stdout with AGENT_C_VERBOSE=1; the metrics handler covers the rest."""
 
     def __init__(self, reply_fn):
         """Initialize callback handler."""
@@ -49,35 +113,98 @@ class SignalCallbackHandler(StdOutCallbackHandler):
         self, action: AgentAction, color: Optional[str] = None, **kwargs: Any
     ) -> Any:
         """Run on agent action."""
-        print(action.log)
+        if VERBOSE:
+            print(action.log)
         self.reply("⚙️🛠️ " + action.log)
 
     def on_tool_error(
         self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
     ) -> None:
-        """Do nothing."""
-        print(error)
+        """Log the error."""
+        log.warning(f"Tool error: {error}")
 
 
-class AgentC:
-    def __init__(self, reply_fn):
-        self.reply = reply_fn
-        self.callback = SignalCallbackHandler(self.reply)
-        self.gpt3 = ChatOpenAI(temperature=0.25, model="gpt-3.5-turbo-16k-0613")
-        self.conservative_llm = ChatOpenAI(
-            temperature=0, model="gpt-3.5-turbo-16k-0613"
+class SharedResources:
+    """Stateless LLM clients, tools and prompts, built once per process on first use
+    and shared by every AgentC session."""
+
+    @cached_property
+    def gpt3(self):
+        return ChatOpenAI(temperature=0.25, model="gpt-3.5-turbo-16k-0613")
+
+    @cached_property
+    def conservative_llm(self):
+        return ChatOpenAI(temperature=0, model="gpt-3.5-turbo-16k-0613")
+
+    @cached_property
+    def gpt4(self):
+        return ChatOpenAI(temperature=0.2, model="gpt-4-0613")
+
+    @cached_property
+    def gpt3_streaming(self):
+        return ChatOpenAI(temperature=0.25, model="gpt-3.5-turbo-16k-0613", streaming=True)
+
+    @cached_property
+    def gpt4_streaming(self):
+        return ChatOpenAI(temperature=0.2, model="gpt-4-0613", streaming=True)
+
+    # self.llama_chat = Replicate(
+    #     model="replicate/llama70b-v2-chat:2c1608e18606fad2812020dc541930f2d0495ce32eee50074220b87300bc16e1"
+    # )
+
+    @cached_property
+    def search_provider(self):
+        return GoogleSearchAPIWrapper()  # DuckDuckGoSearchAPIWrapper()
+
+    def search(self, query):
+        return search_cache.get_or_compute(
+            normalize_key(query),
+            lambda: self.search_provider.results(query, num_results=10),
         )
-        self.gpt4 = ChatOpenAI(temperature=0.2, model="gpt-4-0613")
-        # self.llama_chat = Replicate(
-        #     model="replicate/llama70b-v2-chat:2c1608e18606fad2812020dc541930f2d0495ce32eee50074220b87300bc16e1"
-        # )
-        self.search_provider = GoogleSearchAPIWrapper()  # DuckDuckGoSearchAPIWrapper()
-        self.search = lambda query: self.search_provider.results(query, num_results=10)
-        self.wikipedia = WikipediaAPIWrapper()
-        self.llm_math_chain = LLMMathChain.from_llm(
-            llm=self.conservative_llm, verbose=True
+
+    async def asearch(self, query):
+        # The Google API client is synchronous, so it runs on the default executor.
+        return await search_cache.aget_or_compute(
+            normalize_key(query),
+            lambda: asyncio.to_thread(self.search_provider.results, query, num_results=10),
         )
-        self.basic_tools = [
+
+    @cached_property
+    def wikipedia(self):
+        # Up to 60000 characters of whole articles; `budget.page` decides how much of
+        # them the model gets to see at a time.
+        return WikipediaArticles(
+            doc_content_chars_max=int(os.environ.get("WIKIPEDIA_MAX_CHARS", "60000"))
+        )
+
+    def lookup_wikipedia(self, query, cursor=0):
+        articles = wikipedia_cache.get_or_compute(
+            normalize_key(query), lambda: self.wikipedia.run(query), cacheable=found_articles
+        )
+        return budget.page(articles, cursor)
+
+    async def alookup_wikipedia(self, query, cursor=0):
+        articles = await wikipedia_cache.aget_or_compute(
+            normalize_key(query),
+            lambda: asyncio.to_thread(self.wikipedia.run, query),
+            cacheable=found_articles,
+        )
+        return budget.page(articles, cursor)
+
+    @cached_property
+    def llm_math_chain(self):
+        return LLMMathChain.from_llm(llm=self.conservative_llm, verbose=VERBOSE)
+
+    @cached_property
+    def calculator(self):
+        # Plain math is answered locally; only word problems need the LLM.
+        return registry.create(
+            "calculator", fallback=self.llm_math_chain.run, afallback=self.llm_math_chain.arun
+        )
+
+    @cached_property
+    def basic_tools(self):
+        return [
             # Tool.from_function(
             #     name="Search",
             #     func=self.search_provider.run,
@@ -91,120 +218,343 @@ class AgentC:
             # ),
             Tool(
                 name="Calculator",
-                func=self.llm_math_chain.run,
+                func=self.calculator.run,
+                coroutine=self.calculator.arun,
                 description="Useful for when you need to answer questions about math or perform mathematical operations.",
             ),
-            Tool(
+            StructuredTool.from_function(
                 name="Wikipedia",
-                func=self.wikipedia.run,
+                func=self.lookup_wikipedia,
+                coroutine=self.alookup_wikipedia,
                 description="Useful for when you need to look up facts like from an encyclopedia. \
                     Remember, this is a high-quality trusted source.",
+                args_schema=WikipediaInput,
             ),
         ]
-        self.tools = (
-            self.basic_tools
-            + [
-                StructuredTool.from_function(
-                    name="Search",
-                    func=self.search,
-                    description="Useful for when you need to answer questions about current events. \
-                        You can use this tool to verify your facts with latest information from the internet. \
-                        You are no longer restricted by your out-of-date training data. \
-                        You should ask targeted questions. \
-                        When you can't figure out what to do with a message, try searching for the keywords using this tool. \
-                        If you can't find what you were looking for in the results of this tool, \
-                        DO NOT invent information. Just say \"I couldn't find it on the internet.\".",
-                    args_schema=SearchInput,
-                ),
-                ReaderTool(),
-            ]
-        )
-        self.advanced_tools = (self.tools + [
-            Tool.from_function(
-                name="ImageGenerator",
-                func=(lambda p: genimg_curated(p, self.reply)),
-                description="Useful when you need to create an image that the user asks you to. \
-                    This tool returns a URL of a human-visible image based on text keywords. You \
-                    can return this URL when the user asks for an image. In the input you need to \
-                    describe a scene in English language, mostly using keywords should be okay \
-                    though.",
-            ),
-            HeadlinesTool(),
-            Tool(
-                name="YoutubeTranscriptFetcher",
-                func=yt_transcript,
-                description="Useful for when you need to fetch the transcript of a YouTube video \
-                        to understand it better, find something in it, or to explain it to the user.",
+
+    @cached_property
+    def tools(self):
+        return self.basic_tools + [
+            StructuredTool.from_function(
+                name="Search",
+                func=self.search,
+                coroutine=self.asearch,
+                description="Useful for when you need to answer questions about current events. \
+                    You can use this tool to verify your facts with latest information from the internet. \
+                    You are no longer restricted by your out-of-date training data. \
+                    You should ask targeted questions. \
+                    When you can't figure out what to do with a message, try searching for the keywords using this tool. \
+                    If you can't find what you were looking for in the results of this tool, \
+                    DO NOT invent information. Just say \"I couldn't find it on the internet.\".",
+                args_schema=SearchInput,
             ),
+            registry.create("fetch_page"),
+            registry.create("fetch_pages"),
+            registry.create("research", search=self.search),
         ]
+
+    @cached_property
+    def extra_advanced_tools(self):
+        """Stateless tools that only the advanced agent gets, on top of `tools`."""
+        return [
+            registry.create("headlines"),
+            # Transcript summaries are mapped over the cheap model.
+            registry.create("youtube_transcript", llm=self.gpt3),
             # + load_tools(["open-meteo-api"], llm=self.conservative_llm)
+        ]
+
+    @cached_property
+    def system_message(self):
+        return SystemMessage(
+            content="Your name is SushiBot. You are a helpful AI assistant. Keep the \
+            conversation natuarl and flowing, don't respond with closing statements like \
+            'Is there anything else?'. If you don't know something, look it up on the \
+            internet. If Search results are not useful, try to navigate to known expert \
+            websites to fetch real, up-to-date data, and then root your answers to those facts."
         )
+
+    @cached_property
+    def sushigo_system_message(self):
+        with open("sushigo_sys.txt") as f:
+            return SystemMessage(content=f.read())
+
+
+shared = SharedResources()
+
+
+class StreamingReplyHandler(BaseCallbackHandler):
+    """Callback Handler that sends the answer to signal piece by piece while it is generated.
+
+    Tokens are buffered and flushed at paragraph breaks, at sentence ends once
+    `min_chars` are buffered, or at any word break after `max_chars` or `max_delay`
+    seconds. Function-call steps stream no content, so only answer text is sent."""
+
+    run_inline = True  # keep tokens in order on the async path
+    sentence_end = re.compile(r"[.!?:;](?=\s)|\n")
+
+    def __init__(self, reply_fn, min_chars=120, max_chars=600, max_delay=3.0):
+        self.reply = reply_fn
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.buffer = ""
+        self.last_flush = time.monotonic()
+        self.streamed = False
+
+    def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        self.buffer = ""
+        self.last_flush = time.monotonic()
+
+    def on_chat_model_start(self, *args: Any, **kwargs: Any) -> None:
+        self.on_llm_start()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.buffer += token
+        if not self.buffer.strip():
+            return
+        cut = self.last_break(r"\n\n")
+        if cut < 0 and len(self.buffer) >= self.min_chars:
+            cut = self.last_break(self.sentence_end)
+        overdue = time.monotonic() - self.last_flush >= self.max_delay
+        if cut < 0 and (len(self.buffer) >= self.max_chars or overdue):
+            cut = self.last_break(r"\s")
+        if cut > 0:
+            self.flush(cut)
+
+    def last_break(self, pattern):
+        """End of the last `pattern` match in the buffer that isn't inside a code block."""
+        for match in reversed(list(re.finditer(pattern, self.buffer))):
+            if self.buffer.count("```", 0, match.end()) % 2 == 0:
+                return match.end()
+        return -1
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        self.flush(len(self.buffer))
+
+    def flush(self, cut):
+        text, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+        self.last_flush = time.monotonic()
+        if text:
+            self.streamed = True
+            self.reply(text)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Callback Handler that records where the time of one turn goes.
+
+    Every LLM call (model, latency, prompt and completion tokens) and tool call
+    (latency, bytes returned, whether its cache lookups were hits) goes to
+    `metrics.registry`, and `finish` logs a one-line JSON summary of the turn,
+    including how long it waited in the dispatcher queue. Streaming responses carry
+    no token usage, so their tokens are counted locally."""
+
+    run_inline = True  # tool cache lookups are tracked in the tool's own context
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.started = time.monotonic()
+        self.queue_wait = dispatcher.queue_wait.get()
+        self.lock = threading.Lock()  # tool calls can end concurrently
+        self.runs = {}
+        self.llm = {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.tools = {"calls": 0, "seconds": 0.0, "bytes": 0}
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: Any, **kwargs: Any) -> None:
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model_name") or serialized.get("kwargs", {}).get("model_name")
+        self.runs[kwargs.get("run_id")] = (time.monotonic(), model or "unknown", prompts)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, **kwargs: Any) -> None:
+        self.on_llm_start(serialized, [get_buffer_string(m) for m in messages], **kwargs)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        started, model, prompts = self.runs.pop(kwargs.get("run_id"), (None, None, None))
+        if started is None:
+            return
+        seconds = time.monotonic() - started
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = sum(budget.count(prompt, model) for prompt in prompts)
+        if completion_tokens is None:
+            completion_tokens = sum(
+                budget.count(g.text, model) for gs in response.generations for g in gs
+            )
+        metrics.registry.observe("llm_call_seconds", seconds, model=model)
+        metrics.registry.inc("llm_prompt_tokens_total", prompt_tokens, model=model)
+        metrics.registry.inc("llm_completion_tokens_total", completion_tokens, model=model)
+        with self.lock:
+            self.llm["calls"] += 1
+            self.llm["seconds"] += seconds
+            self.llm["prompt_tokens"] += prompt_tokens
+            self.llm["completion_tokens"] += completion_tokens
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        _, model, _ = self.runs.pop(kwargs.get("run_id"), (None, "unknown", None))
+        metrics.registry.inc("llm_errors_total", model=model)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
+        lookups = []
+        cache.lookups.set(lookups)
+        self.runs[kwargs.get("run_id")] = (time.monotonic(), serialized.get("name"), lookups)
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        started, name, lookups = self.runs.pop(kwargs.get("run_id"), (None, None, None))
+        if started is None:
+            return
+        seconds = time.monotonic() - started
+        size = len(str(output).encode())
+        # A tool call counts as a hit when every cache it consulted could answer it.
+        hit = "none" if not lookups else "hit" if all(s for _, s in lookups) else "miss"
+        metrics.registry.observe("tool_call_seconds", seconds, tool=name)
+        metrics.registry.inc("tool_calls_total", tool=name, cache=hit)
+        metrics.registry.inc("tool_output_bytes_total", size, tool=name)
+        with self.lock:
+            self.tools["calls"] += 1
+            self.tools["seconds"] += seconds
+            self.tools["bytes"] += size
+
+    def on_tool_error(self, error: BaseException, **kwargs: Any) -> None:
+        _, name, _ = self.runs.pop(kwargs.get("run_id"), (None, "unknown", None))
+        metrics.registry.inc("tool_errors_total", tool=name)
+
+    def finish(self):
+        seconds = time.monotonic() - self.started
+        metrics.registry.observe("agent_turn_seconds", seconds, mode=self.mode)
+        summary = {
+            "mode": self.mode,
+            "seconds": round(seconds, 3),
+            "queue_wait": None if self.queue_wait is None else round(self.queue_wait, 3),
+            "llm": {k: round(v, 3) for k, v in self.llm.items()},
+            "tools": {k: round(v, 3) for k, v in self.tools.items()},
+        }
+        log.info(f"Turn: {json.dumps(summary)}")
+
+
+class AgentC:
+    # Slash command -> (agent mode, confirmation reply).
+    MODES = {
+        "/gpt4": ("gpt4_single", "You're now chatting to GPT4 Functions model (single)."),
+        "/multi": ("gpt4_multi", "You're now chatting to GPT4 Functions model (multi)."),
+        "/gpt3": ("gpt3_single", "You're now chatting to GPT3.5."),
+        "/advanced": (
+            "gpt4_advanced",
+            "You're now chatting to GPT4 advanced functions model (single).",
+        ),
+        "/sushigo": ("gpt4_sushigo", "You're now chatting to SushiGo."),
+        # "/react": ("react", "You're now chatting to the ReAct model."),
+        # "/llama": ("llama", "You're now chatting to the LLama-v2-70B model."),
+    }
+
+    # Shared chat model each agent mode runs on; the rest use "gpt4".
+    MODE_LLMS = {"gpt3_single": "gpt3"}
+
+    # Chat models that can stream their answers, by name of the non-streaming model.
+    STREAMING_LLMS = {"gpt4": "gpt4_streaming", "gpt3": "gpt3_streaming"}
+
+    DEFAULT_VARIANTS = 4
+    MAX_VARIANTS = int(os.environ.get("GENIMG_MAX_VARIANTS", "4"))
+
+    def __init__(self, reply_fn, progress_fn=None, documents=None, owner=None):
+        self.reply = reply_fn
+        # Who the session belongs to (the sender). Image jobs are kept by owner, not by
+        # session, as they can outlive an evicted session and reach its rehydration.
+        self.owner = owner or uuid.uuid4().hex
+        # The session's uploaded files (a tools.documents.DocumentStore), if any are kept.
+        self.documents = documents
+        # Progress updates (tool calls, curated prompts) may be batched by the caller.
+        self.progress = progress_fn or reply_fn
+        self.callback = SignalCallbackHandler(self.progress)
         self.memory_key = "chat_history"
-        self.memory = ConversationBufferWindowMemory(
+        self.memory_kind = os.environ.get("AGENT_C_MEMORY", "window")
+        self.memory = self.make_memory(self.memory_kind)
+        # Agent executors are built per mode on first use, see `build_agent`.
+        self.agents = {}
+        self.mode = "gpt4_advanced"
+        self.streaming = False
+
+    def make_memory(self, kind):
+        if kind == "budget":
+            # Summarizes old turns with the cheap model once over the active model's budget.
+            return TokenBudgetMemory(
+                llm=shared.gpt3, memory_key=self.memory_key, return_messages=True
+            )
+        return ConversationBufferWindowMemory(
             k=20, memory_key=self.memory_key, return_messages=True
         )  # return messages is always true in "Window" memory - it's designed for chat agents
+
+    def trim_memory(self):
+        """Drop the messages window memory no longer shows the model. It only trims
+        what goes into the prompt, so otherwise a long conversation would keep growing
+        in RAM and in the session store."""
+        if isinstance(self.memory, ConversationBufferWindowMemory):
+            keep = self.memory.k * 2
+            messages = self.memory.chat_memory.messages
+            if len(messages) > keep:
+                self.memory.chat_memory.messages = messages[-keep:] if keep else []
+
+    def switch_memory(self, kind):
+        """Swap the memory implementation, keeping the conversation so far."""
+        if kind == self.memory_kind:
+            return
+        messages = self.memory.chat_memory.messages
+        self.memory_kind, self.memory = kind, self.make_memory(kind)
+        self.memory.chat_memory.messages = messages
+        self.agents.clear()  # executors hold on to the old memory
+
+    @property
+    def agent(self):
+        model = self.llm(self.MODE_LLMS.get(self.mode, "gpt4")).model_name
+        # Tools size their output in this model's tokens for the rest of the turn.
+        budget.active_model.set(model)
+        if isinstance(self.memory, TokenBudgetMemory):
+            self.memory.model = model
+        key = (self.mode, self.streaming)
+        if key not in self.agents:
+            log.info(f"Building {self.mode} agent (streaming={self.streaming}).")
+            self.agents[key] = self.build_agent(self.mode)
+        return self.agents[key]
+
+    def llm(self, name):
+        """Shared chat model `name`, or its streaming twin when streaming is on."""
+        return getattr(shared, self.STREAMING_LLMS[name] if self.streaming else name)
+
+    def build_agent(self, mode):
+        llm = self.llm(self.MODE_LLMS.get(mode, "gpt4"))
+        session_tools = self.session_tools()
+        extra_prompt_messages = [MessagesPlaceholder(variable_name=self.memory_key)]
         openai_kwargs = {
-            "extra_prompt_messages": [
-                MessagesPlaceholder(variable_name=self.memory_key)
-            ],
-            "system_message": SystemMessage(
-                content="Your name is SushiBot. You are a helpful AI assistant. Keep the \
-                conversation natuarl and flowing, don't respond with closing statements like \
-                'Is there anything else?'. If you don't know something, look it up on the \
-                internet. If Search results are not useful, try to navigate to known expert \
-                websites to fetch real, up-to-date data, and then root your answers to those facts."
-            ),
+            "extra_prompt_messages": extra_prompt_messages,
+            "system_message": shared.system_message,
         }
-        self.gpt4_sushigo = initialize_agent(
-            self.tools,
-            self.gpt4,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            memory=self.memory,
-            verbose=True,
-            agent_kwargs={
-                "extra_prompt_messages": openai_kwargs["extra_prompt_messages"],
-                "system_message": SystemMessage(
-                    content=open('sushigo_sys.txt').read()
+        if mode == "gpt4_sushigo":
+            tools, agent_type = shared.tools, AgentType.OPENAI_FUNCTIONS
+            openai_kwargs = {
+                "extra_prompt_messages": extra_prompt_messages,
+                "system_message": shared.sushigo_system_message,
+            }
+        elif mode == "gpt4_single":
+            tools, agent_type = shared.tools, AgentType.OPENAI_FUNCTIONS
+        elif mode == "gpt4_multi":
+            # Runs the several tool calls the model can make per step concurrently.
+            return ParallelAgentExecutor.from_agent_and_tools(
+                agent=OpenAIMultiFunctionsAgent.from_llm_and_tools(
+                    llm, shared.tools + session_tools, **openai_kwargs
                 ),
-            },
-            callbacks=[self.callback],
-        )
-        self.gpt4_single = initialize_agent(
-            self.tools,
-            self.gpt4,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            memory=self.memory,
-            verbose=True,
-            agent_kwargs=openai_kwargs,
-            callbacks=[self.callback],
-        )
-        self.gpt4_multi = initialize_agent(
-            self.tools,
-            self.gpt4,
-            agent=AgentType.OPENAI_MULTI_FUNCTIONS,
-            memory=self.memory,
-            verbose=True,
-            agent_kwargs=openai_kwargs,
-            callbacks=[self.callback],
-        )
-        self.gpt4_advanced = initialize_agent(
-            self.advanced_tools,
-            self.gpt4,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            memory=self.memory,
-            verbose=True,
-            agent_kwargs=openai_kwargs,
-            callbacks=[self.callback],
-        )
-        self.gpt3_single = initialize_agent(
-            self.tools,
-            self.gpt3,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            memory=self.memory,
-            verbose=True,
-            agent_kwargs=openai_kwargs,
-            callbacks=[self.callback],
-        )
+                tools=shared.tools + session_tools,
+                memory=self.memory,
+                verbose=VERBOSE,
+                callbacks=[self.callback],
+                max_concurrency=int(os.environ.get("AGENT_C_TOOL_CONCURRENCY", "4")),
+                step_timeout=float(os.environ.get("AGENT_C_STEP_TIMEOUT", "120")),
+            )
+        elif mode == "gpt4_advanced":
+            tools, agent_type = self.advanced_tools(), AgentType.OPENAI_FUNCTIONS
+        elif mode == "gpt3_single":
+            tools, agent_type = shared.tools, AgentType.OPENAI_FUNCTIONS
+        else:
+            raise ValueError(f"Unknown agent mode: {mode}")
         # chat_history = MessagesPlaceholder(variable_name=self.memory_key)
         # self.react = initialize_agent(
         #     self.tools,
@@ -232,36 +582,177 @@ class AgentC:
         #     verbose=True,
         # )
         # TODO: Try PlanAndExecute agents
-        self.agent = self.gpt4_advanced
+        return initialize_agent(
+            tools + session_tools,
+            llm,
+            agent=agent_type,
+            memory=self.memory,
+            verbose=VERBOSE,
+            agent_kwargs=openai_kwargs,
+            callbacks=[self.callback],
+        )
+
+    def session_tools(self):
+        """Tools bound to this session: the documents tool, once something was uploaded."""
+        if self.documents is None or not self.documents.documents():
+            return []
+        return [registry.create("documents", store=self.documents)]
+
+    def ingest(self, name, mime_type, chunks):
+        """Read an uploaded file, streamed as byte `chunks`, into this session's documents.
+        Returns a short description of it; raises ValueError if it can't be read."""
+        summary = registry.module("documents").ingest(self.documents, name, mime_type, chunks)
+        self.agents.clear()  # rebuild the agents with the documents tool
+        return summary
+
+    def advanced_tools(self):
+        """Advanced toolset; the image generator reports progress to this session."""
+        return (
+            shared.tools
+            + [
+                Tool.from_function(
+                    name="ImageGenerator",
+                    func=self.generate_image,
+                    coroutine=self.agenerate_image,
+                    description="Useful when you need to create an image that the user asks you to. \
+                        This tool starts generating an image based on text keywords, and the image \
+                        is sent to the user when it is ready, usually within a minute. In the input \
+                        you need to describe a scene in English language, mostly using keywords \
+                        should be okay though.",
+                ),
+            ]
+            + shared.extra_advanced_tools
+        )
+
+    def submit_image(self, prompt, curated=True, variants=1):
+        """Start generating an image in the background; it is sent to the user when ready."""
+        genimg = registry.module("genimg")
+        progress = self.progress  # not `self`, so a running job doesn't hold the session
+        return registry.module("imagejobs").jobs.submit(
+            self.owner,
+            prompt,
+            self.reply,
+            negative_prompt=genimg.default_negative_prompt if curated else "",
+            curate=(lambda p: genimg.curate_prompt(p, progress)) if curated else None,
+            variants=variants,
+        )
+
+    def generate_image(self, prompt):
+        job = self.submit_image(prompt)
+        return (
+            f"Image generation job {job.id} started. The image will be sent to the user as "
+            "soon as it is ready; don't wait for it, and don't make up a URL for it."
+        )
+
+    async def agenerate_image(self, prompt):
+        return self.generate_image(prompt)
+
+    def export_state(self):
+        """Serializable snapshot of this session, see `load_state`."""
+        self.trim_memory()
+        return {
+            "mode": self.mode,
+            "streaming": self.streaming,
+            "memory": self.memory_kind,
+            "summary": getattr(self.memory, "moving_summary_buffer", ""),
+            "messages": messages_to_dict(self.memory.chat_memory.messages),
+        }
+
+    def load_state(self, state):
+        if state.get("mode") in self.agent_modes():
+            self.mode = state["mode"]
+        self.streaming = state.get("streaming", False)
+        self.switch_memory(state.get("memory", self.memory_kind))
+        if isinstance(self.memory, TokenBudgetMemory):
+            self.memory.moving_summary_buffer = state.get("summary", "")
+        self.memory.chat_memory.messages = messages_from_dict(state.get("messages", []))
+        self.trim_memory()  # state saved before trimming was in place
+
+    @classmethod
+    def agent_modes(cls):
+        return {mode for mode, _ in cls.MODES.values()}
 
     def handle(self, msg):
-        self.reply(self.handle2(msg))
+        reply = self.handle2(msg)
+        if reply is not None:
+            self.reply(reply)
+
+    async def ahandle(self, msg):
+        """Async version of `handle`, running the agent on langchain's async path."""
+        reply = await self.ahandle2(msg)
+        if reply is not None:
+            self.reply(reply)
 
     def handle2(self, msg):
+        reply = self.command(msg)
+        if reply is not None:
+            return reply
+        elif msg.startswith("/imgprompt"):
+            chain = registry.module("genimg").img_prompt_chain()
+            return chain(msg[len("/imgprompt") + 1 :])["text"]
+        turn = MetricsCallbackHandler(self.mode)
+        try:
+            if not self.streaming:
+                return self.agent.run(msg, callbacks=[turn])
+            streamer = StreamingReplyHandler(self.reply)
+            answer = self.agent.run(msg, callbacks=[streamer, turn])
+            return None if streamer.streamed else answer
+        finally:
+            turn.finish()
+            self.trim_memory()
+
+    async def ahandle2(self, msg):
+        reply = self.command(msg)
+        if reply is not None:
+            return reply
+        elif msg.startswith("/imgprompt"):
+            chain = registry.module("genimg").img_prompt_chain()
+            return (await chain.acall(msg[len("/imgprompt") + 1 :]))["text"]
+        turn = MetricsCallbackHandler(self.mode)
+        try:
+            if not self.streaming:
+                return await self.agent.arun(msg, callbacks=[turn])
+            streamer = StreamingReplyHandler(self.reply)
+            answer = await self.agent.arun(msg, callbacks=[streamer, turn])
+            return None if streamer.streamed else answer
+        finally:
+            turn.finish()
+            self.trim_memory()
+
+    def command(self, msg):
+        """Reply to session commands that don't wait on I/O, or None if `msg` isn't one."""
         if msg == "/reset":
             self.memory.clear()
+            if self.documents is not None:
+                self.documents.clear()
+                self.agents.clear()
+            imagejobs = registry.loaded("imagejobs")  # no jobs if it was never imported
+            cancelled = imagejobs.jobs.cancel(self.owner) if imagejobs else 0
+            if cancelled:
+                return f"Your session has been reset, and {cancelled} image(s) cancelled."
             return "Your session has been reset."
-        elif msg == "/gpt4":
-            self.agent = self.gpt4_single
-            return "You're now chatting to GPT4 Functions model (single)."
-        elif msg == "/multi":
-            self.agent = self.gpt4_multi
-            return "You're now chatting to GPT4 Functions model (multi)."
-        elif msg == "/gpt3":
-            self.agent = self.gpt3_single
-            return "You're now chatting to GPT3.5."
-        elif msg == "/advanced":
-            self.agent = self.gpt4_advanced
-            return "You're now chatting to GPT4 advanced functions model (single)."
-        elif msg == "/sushigo":
-            self.agent = self.gpt4_sushigo
-            return "You're now chatting to SushiGo."
-        # elif msg == "/react":
-        #     self.agent = self.react
-        #     return "You're now chatting to the ReAct model."
-        # elif msg == "/llama":
-        #     self.agent = self.llama
-        #     return "You're now chatting to the LLama-v2-70B model."
+        elif msg.startswith("/genimg") or msg.startswith("/curated"):
+            curated = msg.startswith("/curated")
+            job = self.submit_image(msg[9:] if curated else msg[8:], curated)
+            return f"🎨 Generating your image (job {job.id}), I'll send it over when it's ready."
+        elif msg.startswith("/variants"):
+            # "/variants 3 <prompt>": several images from one curated prompt, sent together.
+            count, prompt = re.match(r"/variants\s*(\d*)\s*(.*)", msg, re.S).groups()
+            count = max(1, min(int(count or self.DEFAULT_VARIANTS), self.MAX_VARIANTS))
+            job = self.submit_image(prompt, curated=True, variants=count)
+            return f"🎨 Generating {count} variants (job {job.id}), I'll send them over together."
+        elif msg in self.MODES:
+            self.mode, confirmation = self.MODES[msg]
+            return confirmation
+        elif msg == "/stream":
+            self.streaming = not self.streaming
+            return f"Streaming replies are now {'on' if self.streaming else 'off'}."
+        elif msg == "/budget":
+            self.switch_memory("budget")
+            return "Memory now keeps recent messages within a token budget and summarizes older ones."
+        elif msg == "/window":
+            self.switch_memory("window")
+            return "Memory now keeps the last 20 exchanges verbatim."
         elif msg == "/memory":
             history = get_buffer_string(
                 self.memory.buffer,
@@ -269,10 +760,4 @@ class AgentC:
                 ai_prefix=self.memory.ai_prefix,
             )
             return history if history else "Memory is empty."
-        elif msg.startswith("/genimg"):
-            return genimg_raw(msg[8:])
-        elif msg.startswith("/curated"):
-            return genimg_curated(msg[9:])
-        elif msg.startswith("/imgprompt"):
-            return img_prompt_chain(msg[len("/imgprompt") + 1 :])["text"]
-        return self.agent.run(msg)
+        return None
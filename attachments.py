@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import base64
+import hashlib
+import logging as log
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+STATE_DIR = os.environ.get("AGENT_C_STATE_DIR", "state")
+MAX_ATTACHMENT_BYTES = int(os.environ.get("SIGNAL_MAX_ATTACHMENT_MB", "25")) * 2**20
+ATTACHMENT_DEADLINE = float(os.environ.get("SIGNAL_ATTACHMENT_DEADLINE", "20"))
+CACHE_MAX_BYTES = int(os.environ.get("SIGNAL_ATTACHMENT_CACHE_MB", "512")) * 2**20
+# How long a cached URL is trusted before it is revalidated with the origin.
+CACHE_FRESH_FOR = float(os.environ.get("SIGNAL_ATTACHMENT_CACHE_FRESH", str(24 * 3600)))
+CHUNK_SIZE = 3 * 2**16  # a multiple of 3, so chunks base64-encode independently
+
+http = requests.Session()
+http.mount("http://", HTTPAdapter(pool_maxsize=8))
+http.mount("https://", HTTPAdapter(pool_maxsize=8))
+fetchers = ThreadPoolExecutor(max_workers=8, thread_name_prefix="attachments")
+
+
+class AttachmentError(Exception):
+    pass
+
+
+class AttachmentCache:
+    """On-disk cache of downloaded attachments.
+
+    Bodies are stored once per SHA-256 of their content under `root/blobs`, and an
+    SQLite index maps each URL to its blob, mime type and ETag/Last-Modified validators.
+    Blobs are evicted least-recently-used first once they exceed `max_bytes` in total."""
+
+    def __init__(
+        self,
+        root: str = os.path.join(STATE_DIR, "attachments"),
+        max_bytes: int = CACHE_MAX_BYTES,
+        fresh_for: float = CACHE_FRESH_FOR,
+    ):
+        self.root = root
+        self.blobs = os.path.join(root, "blobs")
+        os.makedirs(self.blobs, exist_ok=True)
+        self.index = os.path.join(root, "index.db")
+        self.max_bytes = max_bytes
+        self.fresh_for = fresh_for
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "revalidated": 0, "misses": 0, "evicted": 0}
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT NOT NULL, "
+                "mime TEXT NOT NULL, etag TEXT, last_modified TEXT, checked REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS blobs "
+                "(hash TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.index, timeout=10)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.blobs, digest)
+
+    def lookup(self, url: str) -> Optional[dict]:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT hash, mime, etag, last_modified, checked FROM urls WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None or not os.path.exists(self.path(row[0])):
+            return None
+        return dict(zip(("hash", "mime", "etag", "last_modified", "checked"), row))
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["checked"] < self.fresh_for
+
+    def hit(self, url: str, entry: dict, revalidated: bool = False):
+        now = time.time()
+        with self._connect() as db:
+            if revalidated:
+                db.execute("UPDATE urls SET checked = ? WHERE url = ?", (now, url))
+            db.execute("UPDATE blobs SET last_used = ? WHERE hash = ?", (now, entry["hash"]))
+        self._count("revalidated" if revalidated else "hits")
+
+    def store(self, url: str, tmp_path: str, digest: str, size: int, mime: str, headers):
+        """Move a downloaded body into the cache and point `url` at it."""
+        if os.path.exists(self.path(digest)):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, self.path(digest))
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO blobs (hash, size, last_used) VALUES (?, ?, ?)",
+                (digest, size, now),
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?, ?)",
+                (url, digest, mime, headers.get("ETag"), headers.get("Last-Modified"), now),
+            )
+        self.evict()
+
+    def evict(self):
+        with self.lock, self._connect() as db:
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for digest, size in db.execute(
+                "SELECT hash, size FROM blobs ORDER BY last_used"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                db.execute("DELETE FROM urls WHERE hash = ?", (digest,))
+                db.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.counters["evicted"] += 1
+
+    def miss(self):
+        self._count("misses")
+
+    def _count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+
+cache = AttachmentCache()
+
+
+def encode_file(path: str, mime_type: str) -> str:
+    """Base64 data URI of the file at `path`, encoded chunk by chunk."""
+    parts = [f"data:{mime_type};base64,"]
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+def fetch_data_uri(url: str, mime_type: str, max_bytes: int, deadline: float) -> str:
+    """Return `url` as a base64 data URI, from the cache if possible.
+
+    Fresh cache entries skip the network entirely; stale ones are revalidated with a
+    conditional GET. Otherwise the body is streamed to disk (hashing as it goes) and
+    then into the cache. Raises AttachmentError if the body is larger than `max_bytes`
+    or isn't complete by `deadline` (a `time.monotonic()` timestamp)."""
+
+    def remaining():
+        return max(0.1, deadline - time.monotonic())
+
+    entry = cache.lookup(url)
+    if entry is not None and cache.is_fresh(entry):
+        cache.hit(url, entry)
+        return encode_file(cache.path(entry["hash"]), entry["mime"])
+
+    headers = {}
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    else:
+        try:
+            head = http.head(url, allow_redirects=True, timeout=remaining())
+            length = int(head.headers.get("Content-Length") or 0)
+            if head.ok and length > max_bytes:
+                raise AttachmentError(
+                    f"{url} is {length} bytes, over the {max_bytes} byte cap."
+                )
+        except requests.RequestException as e:
+            # Plenty of servers don't do HEAD; the streamed download enforces the cap too.
+            log.debug(f"HEAD {url} failed: {e}")
+
+    with http.get(url, headers=headers, stream=True, timeout=(5, remaining())) as response:
+        if response.status_code == 304 and entry is not None:
+            cache.hit(url, entry, revalidated=True)
+            return encode_file(cache.path(entry["hash"]), entry["mime"])
+        cache.miss()
+        response.raise_for_status()
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=cache.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise AttachmentError(f"{url} is over the {max_bytes} byte cap.")
+                    if time.monotonic() > deadline:
+                        raise AttachmentError(f"Timed out downloading {url}.")
+                    digest.update(chunk)
+                    f.write(chunk)
+            cache.store(url, tmp_path, digest.hexdigest(), size, mime_type, response.headers)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    log.debug(f"Fetched {size} bytes of {mime_type} from {url}.")
+    return encode_file(cache.path(digest.hexdigest()), mime_type)
+
+
+def load_attachments(
+    urls: List[Tuple[str, str]],
+    max_bytes: int = MAX_ATTACHMENT_BYTES,
+    timeout: float = ATTACHMENT_DEADLINE,
+) -> List[str]:
+    """Fetch `(url, mime_type)` pairs concurrently as data URIs, in the given order.
+
+    Anything that fails, is too large, or isn't done within `timeout` seconds overall
+    is skipped, so the caller can send its message without it."""
+    deadline = time.monotonic() + timeout
+    futures = [
+        fetchers.submit(fetch_data_uri, url, mime_type, max_bytes, deadline)
+        for url, mime_type in urls
+    ]
+    done, not_done = wait(futures, timeout=timeout)
+    attachments = []
+    for (url, _), future in zip(urls, futures):
+        if future in not_done:
+            future.cancel()
+            log.warning(f"Gave up waiting for attachment from {url}.")
+        elif future.exception() is not None:
+            log.error(f"Failed to load attachment from {url}: {future.exception()}")
+        else:
+            attachments.append(future.result())
+    return attachments
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Check what the local calculator answers, and what it leaves to the LLM.
+
+Usage: python benchmarks/calc_checks.py
+
+Each question is run through tools.calc.evaluate and compared with the expected
+answer, or with None where evaluate should raise CalcError so the calculator falls
+back to LLMMathChain. Prints every mismatch and exits with status 1 if there are any.
+Run it after changing the calculator's parser."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tools.calc import CalcError, evaluate
+
+CHECKS = [
+    ("2 + 2", "Answer: 4"),
+    ("what is 3 x 4?", "Answer: 12"),
+    ("2^10", "Answer: 1024"),
+    ("1,000,000 / 4", "Answer: 250000"),
+    ("1,234.5 * 2", "Answer: 2469"),
+    ("15% of 80", "Answer: 12"),
+    ("200 + 15%", "Answer: 230"),
+    ("sqrt(16)", "Answer: 4"),
+    ("sqrt([4, 9])", "Answer: [2, 3]"),
+    ("max(1, 2)", "Answer: 2"),
+    ("mean of 1, 2, 3", "Answer: 2"),
+    ("mean of 1,2,3", "Answer: 2"),
+    ("sum of 1,000, 2,000", "Answer: 3000"),
+    ("factorial(5)", "Answer: 120"),
+    ("factorial([3, 4])", "Answer: [6, 24]"),
+    ("5 km to miles", "Answer: 3.10685596119 miles"),
+    ("212 f in c", "Answer: 100 c"),
+    ("1,5 + 2", None),
+    ("sum of 100,200", None),
+    ("1, 2", None),
+    ("1e308*10", None),
+    ("1/0", None),
+    ("sqrt(-1)", None),
+    ("2**100000", None),
+    ("factorial(1000)*factorial(1000)", None),
+    ("factorial(2.5)", None),
+    ("factorial([3, 4.5])", None),
+    ("__import__('os')", None),
+    ("how many apples does Bob have left", None),
+]
+
+
+def main():
+    failures = 0
+    for question, expected in CHECKS:
+        try:
+            answer = evaluate(question)
+        except CalcError:
+            answer = None
+        if answer != expected:
+            failures += 1
+            print(f"{question!r}: expected {expected!r}, got {answer!r}")
+    print(f"{len(CHECKS) - failures} of {len(CHECKS)} checks passed.")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Compare inline vs process-pool HTML extraction throughput under concurrent readers.
+
+Usage: python benchmarks/extract_bench.py CORPUS_DIR [--threads 8] [--workers 2] [--repeat 3]
+
+CORPUS_DIR holds saved `*.html` pages (e.g. `curl -o page.html URL`). Each mode runs
+every document `--repeat` times from `--threads` threads, like concurrent agent turns."""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import tools.reader as reader
+
+
+def run(extract_fn, docs, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(extract_fn, docs))
+    elapsed = time.perf_counter() - start
+    chars = sum(len(r or "") for r in results)
+    return elapsed, chars
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="directory of saved *.html files")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=reader.EXTRACT_WORKERS or 2)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    docs = []
+    for path in sorted(glob.glob(os.path.join(args.corpus, "*.html"))):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            docs.append(f.read())
+    if not docs:
+        sys.exit(f"No *.html files in {args.corpus}")
+    docs *= args.repeat
+    print(f"{len(docs)} documents, {sum(map(len, docs)) / 2**20:.1f} MiB of HTML, {args.threads} threads")
+
+    reader.EXTRACT_WORKERS = args.workers
+    reader.extract_html(docs[0])  # start the pool's worker processes outside the timing
+
+    for name, fn in (
+        ("inline", reader.extract),
+        (f"pool({args.workers})", reader.extract_html),
+        ("text-only", reader.extract_text_only),
+    ):
+        elapsed, chars = run(fn, docs, args.threads)
+        print(
+            f"{name:>10}: {elapsed:7.2f}s  {len(docs) / elapsed:7.1f} docs/s  {chars} chars extracted"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Scripted stand-ins for the chat models and tools, so load tests spend no credits.
+
+Every turn follows the same script: `tool_calls` function calls to FakeSearch, each
+taking `tool_seconds`, then an answer that repeats the user's message id as
+"ANSWER[<id>]", with each LLM call taking `llm_seconds` (+/- `jitter`). FakeSearch
+results are cached per query like the real search tool's, so a load with few
+distinct prompts exercises the cache as well."""
+
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Any, List, Optional
+
+from langchain.agents import Tool
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import (
+    AIMessage,
+    BaseMessage,
+    ChatGeneration,
+    ChatResult,
+    FunctionMessage,
+    HumanMessage,
+)
+
+from tools.cache import TTLCache, normalize_key
+
+# Message ids the load test puts in front of every prompt, e.g. "load-3-17: ...".
+MESSAGE_ID = re.compile(r"^(load-\d+-\d+):\s*")
+
+
+def latency(seconds: float, jitter: float) -> float:
+    return max(0.0, seconds + random.uniform(-jitter, jitter))
+
+
+def result(query: str, size: int) -> str:
+    line = f"Result for {query}. "
+    return (line * (size // len(line) + 1))[:size]
+
+
+class ScriptedChatModel(ChatOpenAI):
+    """A ChatOpenAI (which the functions agents insist on) that never calls OpenAI."""
+
+    llm_seconds: float = 1.0
+    jitter: float = 0.0
+    tool_calls: int = 1
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        human = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage))
+        text = messages[human].content
+        calls = sum(isinstance(m, FunctionMessage) for m in messages[human:])
+        match = MESSAGE_ID.match(text)
+        if calls < self.tool_calls:
+            query = text[match.end() :] if match else text
+            message = AIMessage(
+                content="",
+                additional_kwargs={
+                    "function_call": {
+                        "name": "FakeSearch",
+                        "arguments": json.dumps({"__arg1": query}),
+                    }
+                },
+            )
+        else:
+            message = AIMessage(content=f"ANSWER[{match.group(1) if match else ''}] {text}")
+        usage = {
+            "prompt_tokens": sum(len(m.content) for m in messages) // 4,
+            "completion_tokens": len(message.content) // 4 + 10,
+        }
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={"token_usage": usage, "model_name": self.model_name},
+        )
+
+    def _generate(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any
+    ) -> ChatResult:
+        time.sleep(latency(self.llm_seconds, self.jitter))
+        return self._result(messages)
+
+    async def _agenerate(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any
+    ) -> ChatResult:
+        await asyncio.sleep(latency(self.llm_seconds, self.jitter))
+        return self._result(messages)
+
+
+def fake_search(tool_seconds: float, jitter: float, tool_bytes: int) -> Tool:
+    results = TTLCache("fake_search", ttl=3600, max_items=1024)
+
+    def search(query: str) -> str:
+        def compute():
+            time.sleep(latency(tool_seconds, jitter))
+            return result(query, tool_bytes)
+
+        return results.get_or_compute(normalize_key(query), compute)
+
+    async def asearch(query: str) -> str:
+        async def compute():
+            await asyncio.sleep(latency(tool_seconds, jitter))
+            return result(query, tool_bytes)
+
+        return await results.aget_or_compute(normalize_key(query), compute)
+
+    return Tool.from_function(
+        name="FakeSearch",
+        func=search,
+        coroutine=asearch,
+        description="Search the web for a query.",
+    )
+
+
+def install(shared, llm_seconds=1.0, tool_seconds=0.5, jitter=0.0, tool_calls=1, tool_bytes=2000):
+    """Replace the chat models and tools of agent_c's `shared` with scripted ones,
+    before anything has built the real ones."""
+    for name, model in (
+        ("gpt4", "gpt-4-0613"),
+        ("gpt4_streaming", "gpt-4-0613"),
+        ("gpt3", "gpt-3.5-turbo-16k-0613"),
+        ("gpt3_streaming", "gpt-3.5-turbo-16k-0613"),
+        ("conservative_llm", "gpt-3.5-turbo-16k-0613"),
+    ):
+        setattr(
+            shared,
+            name,
+            ScriptedChatModel(
+                model=model, llm_seconds=llm_seconds, jitter=jitter, tool_calls=tool_calls
+            ),
+        )
+    shared.tools = [fake_search(tool_seconds, jitter, tool_bytes)]
+    shared.extra_advanced_tools = []
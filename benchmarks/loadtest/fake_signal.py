@@ -0,0 +1,109 @@
+"""A local stand-in for signal-cli-rest-api, enough for signal_server to run against.
+
+It serves the /v1/receive websocket, /v2/send, the typing indicator and attachments,
+like the real API in json-rpc mode. `deliver` pushes an incoming message to the
+connected server; every message the server sends is passed to `on_send`."""
+
+import asyncio
+import json
+import struct
+import time
+import zlib
+from collections import defaultdict
+from typing import Callable, Optional
+
+from aiohttp import web
+
+
+def png() -> bytes:
+    """A 1x1 PNG, served as the fake image generator's output."""
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(b"\x00\xff\xff\xff"))
+        + chunk(b"IEND", b"")
+    )
+
+
+class FakeSignal:
+    def __init__(self, bot: str, send_seconds: float = 0.05):
+        self.bot = bot
+        self.send_seconds = send_seconds
+        self.sockets = set()
+        self.connected = asyncio.Event()
+        self.counters = defaultdict(int)
+        # Called with (time, recipient, message, number of attachments) for every send.
+        self.on_send: Optional[Callable[[float, str, str, int], None]] = None
+        self.image = png()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/v1/receive/{number}", self.receive)
+        app.router.add_post("/v2/send", self.send)
+        app.router.add_put("/v1/typing-indicator/{number}", self.typing)
+        app.router.add_delete("/v1/typing-indicator/{number}", self.typing)
+        app.router.add_get("/v1/attachments/{id}", self.attachment)
+        app.router.add_get("/image.png", self.attachment)
+        return app
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    async def receive(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        self.connected.set()
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self.sockets.discard(ws)
+            if not self.sockets:
+                self.connected.clear()
+        return ws
+
+    async def send(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        await asyncio.sleep(self.send_seconds)
+        self.counters["sends"] += 1
+        now = time.monotonic()
+        for recipient in payload["recipients"]:
+            if self.on_send:
+                self.on_send(
+                    now, recipient, payload["message"], len(payload.get("base64_attachments", []))
+                )
+        return web.json_response({"timestamp": str(int(time.time() * 1000))}, status=201)
+
+    async def typing(self, request: web.Request) -> web.Response:
+        self.counters[f"typing_{request.method.lower()}"] += 1
+        return web.Response(status=204)
+
+    async def attachment(self, request: web.Request) -> web.Response:
+        self.counters["attachments"] += 1
+        return web.Response(body=self.image, content_type="image/png")
+
+    async def deliver(self, sender: str, text: str):
+        """Push a message from `sender` to every connected receiver."""
+        timestamp = int(time.time() * 1000)
+        message = {
+            "envelope": {
+                "source": sender,
+                "sourceNumber": sender,
+                "sourceUuid": f"uuid-{sender}",
+                "sourceName": f"Load {sender}",
+                "sourceDevice": 1,
+                "timestamp": timestamp,
+                "dataMessage": {"timestamp": timestamp, "message": text, "expiresInSeconds": 0},
+            },
+            "account": self.bot,
+        }
+        for ws in list(self.sockets):
+            await ws.send_str(json.dumps(message))
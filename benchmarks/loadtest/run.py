@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""Replay concurrent Signal users against the real signal_server, fully offline.
+
+Usage: python benchmarks/loadtest/run.py [--senders 8] [--rate 2] [--duration 60]
+           [--llm 1.0] [--tool 0.5] [--jitter 0.2] [--tool-calls 1] [--distinct 20]
+           [--images 0.1] [--workers 4 | --async-turns 64] [--json] [--save FILE] [--baseline FILE] [--tolerance 0.2]
+
+signal_server runs in a subprocess (benchmarks/loadtest/server.py) against a local
+signal-cli-rest-api stub (fake_signal.py), with scripted chat models and tools
+(fake_llm.py) and the fake image backend, so no credits or Signal account are used.
+`--senders` users send `--rate` messages per second between them for `--duration`
+seconds, drawn from `--distinct` prompts; an `--images` fraction of them are /genimg
+requests. We report reply latency percentiles (message in to answer sent), throughput,
+rejected ("I'm busy") and lost messages, and the server's RSS growth and thread count
+(read from /proc, so Linux only). `--async-turns` runs the turns on the server's
+async path (AgentC.ahandle on one event loop) instead of on worker threads, so the
+two can be compared under the same load.
+
+`--save` writes the report as a baseline; `--baseline` compares against one and exits
+with status 1 if p95/p99 latency, throughput or RSS growth regress by more than
+`--tolerance`, or if any message goes unanswered."""
+
+import argparse
+import asyncio
+import json
+import logging as log
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_signal import FakeSignal
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+BOT = "+10000000000"
+ADMIN = "+10000000001"
+
+ANSWER = re.compile(r"ANSWER\[(load-\d+-\d+)\]")
+BUSY = "I'm busy with your earlier messages"
+
+# Absolute slack for the RSS gate, as small baselines are mostly noise.
+RSS_SLACK_MB = 16
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def proc_status(pid):
+    """(RSS in MB, thread count) of process `pid`."""
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()
+    return int(fields["VmRSS"][0]) / 1024, int(fields["Threads"][0])
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.signal = FakeSignal(BOT, send_seconds=args.send_latency)
+        self.signal.on_send = self.on_send
+        self.sent_at = {}  # message id -> time it was delivered to the server
+        self.answered = {}  # message id -> reply latency
+        self.answers = asyncio.Event()
+        self.rejected = 0
+        self.images = {"requested": 0, "delivered": 0}
+        self.admin_replies = []
+        self.peak_threads = 0
+
+    def on_send(self, now, recipient, message, attachments):
+        if recipient == ADMIN:
+            self.admin_replies.append(message)
+        if message.startswith(BUSY):
+            self.rejected += 1
+        elif message.startswith("🖼️"):
+            self.images["delivered"] += message.count("🖼️")
+        for message_id in ANSWER.findall(message):
+            if message_id in self.sent_at and message_id not in self.answered:
+                self.answered[message_id] = now - self.sent_at[message_id]
+        self.answers.set()
+
+    def unanswered(self):
+        requested = len(self.sent_at) + self.images["requested"]
+        return requested - len(self.answered) - self.images["delivered"] - self.rejected
+
+    async def wait_for(self, condition, timeout):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.answers.clear()
+            try:
+                await asyncio.wait_for(self.answers.wait(), min(remaining, 1))
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    def start_server(self, state_dir, log_file):
+        env = os.environ | {
+            "SIGNAL_API_URL": f"http://127.0.0.1:{self.args.port}",
+            "SIGNAL_BOT": BOT,
+            "SIGNAL_ADMIN": ADMIN,
+            "SIGNAL_ALLOWLIST": ",".join([ADMIN] + self.senders),
+            "AGENT_C_STATE_DIR": state_dir,
+            "GENIMG_BACKEND": "fake",
+            "GENIMG_FAKE_SECONDS": str(self.args.image_seconds),
+            "GENIMG_FAKE_URL": f"http://127.0.0.1:{self.args.port}/image.png",
+            "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "unused"),
+        }
+        if self.args.workers:
+            env["SIGNAL_WORKERS"] = str(self.args.workers)
+        if self.args.async_turns:
+            env["SIGNAL_ASYNC_TURNS"] = str(self.args.async_turns)
+        command = [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+            f"--llm={self.args.llm}",
+            f"--tool={self.args.tool}",
+            f"--jitter={self.args.jitter}",
+            f"--tool-calls={self.args.tool_calls}",
+            f"--tool-bytes={self.args.tool_bytes}",
+        ]
+        return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=log_file)
+
+    async def sample(self, pid):
+        while True:
+            try:
+                _, threads = proc_status(pid)
+            except FileNotFoundError:
+                return
+            self.peak_threads = max(self.peak_threads, threads)
+            await asyncio.sleep(0.5)
+
+    async def run(self, state_dir, log_file):
+        args = self.args
+        self.senders = [f"+1555{i:07d}" for i in range(args.senders)]
+        prompts = [f"tell me about topic {i}" for i in range(args.distinct)]
+        runner = await self.signal.start("127.0.0.1", args.port)
+        server = self.start_server(state_dir, log_file)
+        sampler = None
+        try:
+            deadline = time.monotonic() + args.startup_timeout
+            while not self.signal.connected.is_set():
+                if server.poll() is not None:
+                    raise RuntimeError(f"the server exited with status {server.returncode}")
+                if time.monotonic() > deadline:
+                    raise RuntimeError("the server never connected to the websocket")
+                await asyncio.sleep(0.1)
+            # The first turn waits for the agent to import; keep that out of the numbers.
+            self.sent_at["load-0-0"] = time.monotonic()
+            await self.signal.deliver(ADMIN, "load-0-0: warm up")
+            if not await self.wait_for(lambda: "load-0-0" in self.answered, args.startup_timeout):
+                raise RuntimeError("the server never answered the warm-up message")
+            del self.answered["load-0-0"], self.sent_at["load-0-0"]
+
+            rss_start, threads_start = proc_status(server.pid)
+            sampler = asyncio.create_task(self.sample(server.pid))
+            started = time.monotonic()
+            total = int(args.rate * args.duration)
+            for n in range(total):
+                await asyncio.sleep(max(0, started + n / args.rate - time.monotonic()))
+                sender = n % args.senders
+                if random.random() < args.images:
+                    self.images["requested"] += 1
+                    await self.signal.deliver(self.senders[sender], f"/genimg {random.choice(prompts)}")
+                    continue
+                message_id = f"load-{sender + 1}-{n}"
+                self.sent_at[message_id] = time.monotonic()
+                await self.signal.deliver(
+                    self.senders[sender], f"{message_id}: {random.choice(prompts)}"
+                )
+            # Wait for every message that wasn't turned away to be answered.
+            await self.wait_for(lambda: self.unanswered() <= 0, args.drain_timeout)
+            finished = time.monotonic()
+            rss_end, threads_end = proc_status(server.pid)
+
+            replies = len(self.admin_replies)
+            await self.signal.deliver(ADMIN, "/stats")
+            await self.wait_for(lambda: len(self.admin_replies) > replies, 10)
+            try:
+                server_metrics = json.loads(self.admin_replies[-1])
+            except (IndexError, ValueError):
+                server_metrics = None
+        finally:
+            if sampler:
+                sampler.cancel()
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            await runner.cleanup()
+
+        latencies = list(self.answered.values())
+        last_answer = max(
+            (self.sent_at[m] + s for m, s in self.answered.items()), default=finished
+        )
+        return {
+            "config": {
+                k: getattr(args, k)
+                for k in (
+                    "senders",
+                    "rate",
+                    "duration",
+                    "llm",
+                    "tool",
+                    "tool_calls",
+                    "distinct",
+                    "images",
+                    "workers",
+                    "async_turns",
+                )
+            },
+            "sent": len(self.sent_at),
+            "answered": len(self.answered),
+            "rejected": self.rejected,
+            "lost": self.unanswered(),
+            "images": self.images,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies, default=None),
+            "throughput": len(self.answered) / max(last_answer - started, 1e-9),
+            "rss_start_mb": rss_start,
+            "rss_growth_mb": rss_end - rss_start,
+            "threads_start": threads_start,
+            "threads_end": threads_end,
+            "threads_peak": self.peak_threads,
+            "stub": dict(self.signal.counters),
+            "server_metrics": server_metrics,
+        }
+
+
+def regressions(report, baseline, tolerance):
+    """Human-readable reasons `report` is worse than `baseline`, if any."""
+    problems = []
+    if report["lost"]:
+        problems.append(f"{report['lost']} messages were never answered")
+    for key in ("p95", "p99"):
+        if report[key] is None or baseline.get(key) is None:
+            continue
+        if report[key] > baseline[key] * (1 + tolerance):
+            problems.append(f"{key} latency {report[key]:.2f}s > baseline {baseline[key]:.2f}s")
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        problems.append(
+            f"throughput {report['throughput']:.2f}/s < baseline {baseline['throughput']:.2f}/s"
+        )
+    allowed = max(baseline["rss_growth_mb"] * (1 + tolerance), baseline["rss_growth_mb"] + RSS_SLACK_MB)
+    if report["rss_growth_mb"] > allowed:
+        problems.append(
+            f"RSS grew {report['rss_growth_mb']:.1f}MB > baseline {baseline['rss_growth_mb']:.1f}MB"
+        )
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--senders", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second, in total")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of load")
+    parser.add_argument("--llm", type=float, default=1.0, help="seconds per LLM call")
+    parser.add_argument("--tool", type=float, default=0.5, help="seconds per tool call")
+    parser.add_argument("--jitter", type=float, default=0.2, help="+/- seconds on each call")
+    parser.add_argument("--tool-calls", type=int, default=1, help="tool calls per turn")
+    parser.add_argument("--tool-bytes", type=int, default=2000, help="size of tool results")
+    parser.add_argument("--distinct", type=int, default=20, help="number of different prompts")
+    parser.add_argument("--images", type=float, default=0.0, help="fraction of /genimg messages")
+    parser.add_argument("--image-seconds", type=float, default=5.0)
+    parser.add_argument("--send-latency", type=float, default=0.05, help="seconds per /v2/send")
+    parser.add_argument("--workers", type=int, help="SIGNAL_WORKERS for the server")
+    parser.add_argument(
+        "--async-turns", type=int, help="SIGNAL_ASYNC_TURNS for the server (run turns async)"
+    )
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print one JSON report")
+    parser.add_argument("--save", help="write the report to this file as a baseline")
+    parser.add_argument("--baseline", help="fail on regressions against this saved report")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix="agent-c-loadtest-") as state_dir:
+        with open(os.path.join(state_dir, "server.log"), "w") as log_file:
+            try:
+                report = asyncio.run(LoadTest(args).run(state_dir, log_file))
+            except Exception as e:
+                log_file.flush()
+                with open(log_file.name) as f:
+                    sys.stderr.write(f.read()[-4000:])
+                sys.exit(f"load test failed: {e}")
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print(
+            f"sent {report['sent']}, answered {report['answered']}, "
+            f"rejected {report['rejected']}, lost {report['lost']}"
+        )
+        if report["answered"]:
+            print(
+                f"reply latency: p50={report['p50']:.2f}s p95={report['p95']:.2f}s "
+                f"p99={report['p99']:.2f}s max={report['max']:.2f}s"
+            )
+        print(f"throughput: {report['throughput']:.2f} replies/s")
+        print(f"images: {report['images']['delivered']} of {report['images']['requested']} delivered")
+        print(
+            f"server: RSS {report['rss_start_mb']:.1f}MB +{report['rss_growth_mb']:.1f}MB, "
+            f"threads {report['threads_start']} -> {report['threads_end']} "
+            f"(peak {report['threads_peak']})"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = regressions(report, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"regression: {problem}", file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""signal_server with scripted chat models and tools, for run.py to start.
+
+Usage: python benchmarks/loadtest/server.py [--llm 1.0] [--tool 0.5] [--jitter 0.2]
+           [--tool-calls 1] [--tool-bytes 2000]
+
+Everything else (SIGNAL_API_URL, SIGNAL_BOT, GENIMG_BACKEND, ...) comes from the
+environment, as for the real server."""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+import fake_llm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--llm", type=float, default=1.0, help="seconds per LLM call")
+    parser.add_argument("--tool", type=float, default=0.5, help="seconds per tool call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds on each call")
+    parser.add_argument("--tool-calls", type=int, default=1, help="tool calls per turn")
+    parser.add_argument("--tool-bytes", type=int, default=2000, help="size of tool results")
+    args = parser.parse_args()
+
+    import agent_c
+    import signal_server
+
+    fake_llm.install(
+        agent_c.shared,
+        llm_seconds=args.llm,
+        tool_seconds=args.tool,
+        jitter=args.jitter,
+        tool_calls=args.tool_calls,
+        tool_bytes=args.tool_bytes,
+    )
+    signal_server.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Measure how long the server takes to import before it can connect, and what's slow.
+
+Usage: python benchmarks/startup.py [--repeat 3] [--top 15] [--json] [--max-seconds S]
+
+Each target is imported in a fresh `python -X importtime` process, `--repeat` times,
+keeping the fastest run. `server` is what signal_server imports before opening the
+websocket; `agent` is agent_c, which the server imports in the background once
+connected, and `tools` is every module in the tool registry. For each target we report
+the total import time and the `--top` slowest modules by cumulative time. With
+`--max-seconds`, exit with status 1 if the server imports take longer than that,
+so the number can be tracked in CI."""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from tools.registry import TOOLS
+
+TARGETS = {
+    "server": [
+        "attachments",
+        "dispatcher",
+        "metrics",
+        "outbox",
+        "sessions",
+        "signal_client",
+        "tools.cache",
+        "tools.registry",
+        "websocket",
+    ],
+    "agent": ["agent_c"],
+    "tools": sorted({f"tools.{module}" for module, _ in TOOLS.values()}),
+}
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(modules):
+    """{module: (self_us, cumulative_us, depth)} for one fresh interpreter, or an error."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return result.stderr.strip().splitlines()[-1]
+    times = {}
+    for match in LINE.finditer(result.stderr):
+        self_us, cumulative_us, indent, name = match.groups()
+        times[name] = (int(self_us), int(cumulative_us), (len(indent) - 1) // 2)
+    return times
+
+
+def measure(modules, repeat):
+    best = None
+    for _ in range(repeat):
+        times = import_times(modules)
+        if isinstance(times, str):
+            return times
+        total = sum(cumulative for _, cumulative, depth in times.values() if depth == 0)
+        if best is None or total < best[0]:
+            best = (total, times)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", action="store_true", help="print one JSON report")
+    parser.add_argument("--max-seconds", type=float, help="fail if server imports take longer")
+    args = parser.parse_args()
+
+    report = {}
+    for target, modules in TARGETS.items():
+        measured = measure(modules, args.repeat)
+        if isinstance(measured, str):
+            report[target] = {"error": measured}
+            continue
+        total, times = measured
+        slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)
+        report[target] = {
+            "seconds": total / 1e6,
+            "modules": len(times),
+            "slowest": [
+                {"module": name, "cumulative": c / 1e6, "self": s / 1e6}
+                for name, (s, c, _) in slowest[: args.top]
+            ],
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        for target, result in report.items():
+            if "error" in result:
+                print(f"{target}: failed to import: {result['error']}\n")
+                continue
+            print(f"{target}: {result['seconds']:.3f}s, {result['modules']} modules")
+            for entry in result["slowest"]:
+                print(
+                    f"  {entry['cumulative']:8.3f}s cumulative {entry['self']:8.3f}s self  {entry['module']}"
+                )
+            print()
+
+    server = report["server"]
+    if args.max_seconds is not None and server.get("seconds", float("inf")) > args.max_seconds:
+        print(f"server imports exceed {args.max_seconds}s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextvars
+import logging as log
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+import metrics
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# How long the job running in this context waited in its queue, for per-turn summaries.
+queue_wait: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "queue_wait", default=None
+)
+
+
+class Dispatcher:
+    """Bounded executor that runs jobs for the same key one at a time, in order,
+    while jobs for different keys run concurrently on a shared pool of workers."""
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_queue: Optional[int] = 3,
+        name: str = "dispatcher",
+        wait_samples: int = 1000,
+    ):
+        self.name = name
+        self.max_queue = max_queue
+        self.pool = self._start(workers)
+        self.lock = threading.Lock()
+        self.queues: Dict[str, deque] = {}
+        self.active = set()
+        self.waits = deque(maxlen=wait_samples)
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, key: str, fn: Callable, *args, **kwargs) -> bool:
+        """Queue `fn(*args, **kwargs)` behind any pending jobs for `key`.
+
+        Returns False (and drops the job) if `key` already has `max_queue` jobs waiting."""
+        with self.lock:
+            queue = self.queues.setdefault(key, deque())
+            if self.max_queue is not None and len(queue) >= self.max_queue:
+                self.rejected += 1
+                log.warning(f"[{self.name}] Queue for {key} is full, rejecting job.")
+                return False
+            queue.append((time.monotonic(), fn, args, kwargs))
+            self.submitted += 1
+            if key not in self.active:
+                self.active.add(key)
+                self._schedule(key)
+        return True
+
+    def _start(self, workers: int):
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.name)
+
+    def _schedule(self, key: str):
+        """Start draining `key`'s queue. Caller must hold the lock."""
+        self.pool.submit(self._drain, key)
+
+    def _next(self, key: str):
+        """Pop the next job for `key`, recording how long it waited, or return None
+        and mark `key` idle once its queue is empty."""
+        with self.lock:
+            queue = self.queues.get(key)
+            if not queue:
+                self.queues.pop(key, None)
+                self.active.discard(key)
+                return None
+            queued_at, fn, args, kwargs = queue.popleft()
+        wait = time.monotonic() - queued_at
+        self.waits.append(wait)
+        queue_wait.set(wait)
+        metrics.registry.observe("dispatcher_wait_seconds", wait, queue=self.name)
+        log.info(f"[{self.name}] Job for {key} waited {wait:.3f}s in queue.")
+        return fn, args, kwargs
+
+    def _drain(self, key: str):
+        while (job := self._next(key)) is not None:
+            fn, args, kwargs = job
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+
+    def pending(self, key: Optional[str] = None) -> int:
+        """Number of jobs waiting (not yet running), for one key or overall."""
+        with self.lock:
+            if key is not None:
+                return len(self.queues.get(key, ()))
+            return sum(len(q) for q in self.queues.values())
+
+    def stats(self) -> dict:
+        """Queue wait-time summary over the most recent jobs, in seconds."""
+        with self.lock:
+            waits = sorted(self.waits)
+            pending = sum(len(q) for q in self.queues.values())
+            stats = {
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "pending": pending,
+                "active_keys": len(self.active),
+            }
+        if waits:
+            stats |= {
+                "wait_avg": sum(waits) / len(waits),
+                "wait_p50": waits[len(waits) // 2],
+                "wait_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))],
+                "wait_max": waits[-1],
+            }
+        return stats
+
+    def shutdown(self, wait: bool = True):
+        self.pool.shutdown(wait=wait)
+
+
+class AsyncDispatcher(Dispatcher):
+    """Dispatcher for coroutine functions. Jobs run as tasks on an event loop in a
+    thread of its own, so a job waiting on I/O holds no thread; `workers` caps how
+    many run at once."""
+
+    def _start(self, workers: int):
+        self.loop = asyncio.new_event_loop()
+        self.running = asyncio.Semaphore(workers)
+        self.tasks = set()  # the loop only keeps weak references to its tasks
+        self.thread = threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True)
+        self.thread.start()
+        return None
+
+    def _schedule(self, key: str):
+        self.loop.call_soon_threadsafe(self._spawn, key)
+
+    def _spawn(self, key: str):
+        task = self.loop.create_task(self._adrain(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _adrain(self, key: str):
+        try:
+            while True:
+                # Popped only once a slot is free, so waiting for one counts as queue wait.
+                async with self.running:
+                    job = self._next(key)
+                    if job is None:
+                        return
+                    fn, args, kwargs = job
+                    try:
+                        await fn(*args, **kwargs)
+                    except Exception:
+                        traceback.print_exc()
+                    except asyncio.CancelledError:
+                        # Raised inside the job (a cancelled request, say) rather than
+                        # at this task, so it only ends that job.
+                        if asyncio.current_task().cancelling():
+                            raise
+                        log.error(f"[{self.name}] Job for {key} was cancelled.")
+        except BaseException:
+            # Don't leave `key` marked active with nothing draining it, or every later
+            # job for it would queue up behind a drain that will never come.
+            with self.lock:
+                self.active.discard(key)
+            raise
+
+    def shutdown(self, wait: bool = True):
+        async def finish():
+            if wait and self.tasks:
+                await asyncio.wait(set(self.tasks))
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(finish(), self.loop)
+        if wait:
+            self.thread.join()
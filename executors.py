@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import contextvars
+import logging as log
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple, Union
+
+from langchain.agents import AgentExecutor
+from langchain.agents.tools import InvalidTool
+from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.schema import AgentAction, AgentFinish, OutputParserException
+from langchain.tools import BaseTool
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """AgentExecutor that runs all tool calls the model asks for in one step concurrently.
+
+    Meant for agents that can return several actions per step, like
+    OpenAIMultiFunctionsAgent. At most `max_concurrency` tools run at once, and tools
+    still running after `step_timeout` seconds are reported as timed out. Observations
+    are returned in the order the model asked for them, and a failing tool only fails
+    its own observation. (langchain's async path already gathers tool calls.)"""
+
+    max_concurrency: int = 4
+    step_timeout: float = 120
+
+    def _take_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Union[AgentFinish, List[Tuple[AgentAction, str]]]:
+        try:
+            if hasattr(self, "_prepare_intermediate_steps"):
+                intermediate_steps = self._prepare_intermediate_steps(intermediate_steps)
+            output = self.agent.plan(
+                intermediate_steps,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **inputs,
+            )
+        except OutputParserException as e:
+            if not self.handle_parsing_errors:
+                raise
+            if isinstance(self.handle_parsing_errors, str):
+                observation = self.handle_parsing_errors
+            elif callable(self.handle_parsing_errors):
+                observation = self.handle_parsing_errors(e)
+            else:
+                observation = "Invalid or incomplete response"
+            return [(AgentAction("_Exception", observation, str(e)), observation)]
+        if isinstance(output, AgentFinish):
+            return output
+
+        actions = [output] if isinstance(output, AgentAction) else output
+        for action in actions:
+            if run_manager:
+                run_manager.on_agent_action(action, color="green")
+        if len(actions) == 1:
+            return [
+                (
+                    actions[0],
+                    self._run_action(actions[0], name_to_tool_map, color_mapping, run_manager),
+                )
+            ]
+
+        log.info(f"Running {len(actions)} tool calls concurrently.")
+        pool = ThreadPoolExecutor(
+            max_workers=min(self.max_concurrency, len(actions)),
+            thread_name_prefix="tool-call",
+        )
+        futures = [
+            # Tools see the same context variables (e.g. the active model) as the agent.
+            pool.submit(
+                contextvars.copy_context().run,
+                self._run_action,
+                action,
+                name_to_tool_map,
+                color_mapping,
+                run_manager,
+            )
+            for action in actions
+        ]
+        _, not_done = wait(futures, timeout=self.step_timeout)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        result = []
+        for action, future in zip(actions, futures):
+            if future in not_done:
+                observation = f"{action.tool} timed out after {self.step_timeout:.0f}s."
+            elif future.exception() is not None:
+                observation = f"{action.tool} failed: {future.exception()}"
+            else:
+                observation = future.result()
+            result.append((action, observation))
+        return result
+
+    def _run_action(
+        self,
+        action: AgentAction,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        run_manager: Optional[CallbackManagerForChainRun],
+    ) -> str:
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        callbacks = run_manager.get_child() if run_manager else None
+        if action.tool not in name_to_tool_map:
+            return InvalidTool().run(
+                {
+                    "requested_tool_name": action.tool,
+                    "available_tool_names": list(name_to_tool_map.keys()),
+                },
+                verbose=self.verbose,
+                color=None,
+                callbacks=callbacks,
+                **tool_run_kwargs,
+            )
+        tool = name_to_tool_map[action.tool]
+        if tool.return_direct:
+            tool_run_kwargs["llm_prefix"] = ""
+        return tool.run(
+            action.tool_input,
+            verbose=self.verbose,
+            color=color_mapping[action.tool],
+            callbacks=callbacks,
+            **tool_run_kwargs,
+        )
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import logging as log
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from langchain.chains import LLMChain
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.schema import BaseMessage, SystemMessage, get_buffer_string
+from langchain.schema.language_model import BaseLanguageModel
+from pydantic import Field
+
+from tools.tokens import DEFAULT_MODEL, count_tokens
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Tokens of conversation history to send along with each prompt, per model.
+MEMORY_TOKEN_BUDGETS = {
+    "gpt-4-0613": 2500,
+    "gpt-3.5-turbo-16k-0613": 6000,
+}
+DEFAULT_TOKEN_BUDGET = 2500
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+summarizers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarizer")
+
+
+class TokenBudgetMemory(BaseChatMemory):
+    """Chat memory that keeps the history sent to the model within a token budget.
+
+    When the history goes over the budget for `model`, the oldest turns are folded into
+    a running summary by `llm` on a background thread, so the reply isn't held up.
+    Until that finishes, the oldest messages are simply left out of the prompt."""
+
+    llm: BaseLanguageModel
+    model: str = DEFAULT_MODEL
+    memory_key: str = "history"
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+    return_messages: bool = True
+    moving_summary_buffer: str = ""
+    # Share of the budget left for verbatim recent turns after summarizing.
+    keep_ratio: float = 0.5
+    lock: Any = Field(default_factory=threading.Lock, exclude=True)
+    summarizing: bool = False
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    @property
+    def budget(self) -> int:
+        return MEMORY_TOKEN_BUDGETS.get(self.model, DEFAULT_TOKEN_BUDGET)
+
+    @property
+    def buffer(self) -> List[BaseMessage]:
+        """The summary (if any) followed by every message not yet summarized."""
+        with self.lock:
+            summary = self._summary_messages()
+            return summary + list(self.chat_memory.messages)
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            summary = self._summary_messages()
+            messages = list(self.chat_memory.messages)
+        remaining = self.budget - sum(self._tokens(m) for m in summary)
+        kept = []
+        for message in reversed(messages):
+            remaining -= self._tokens(message)
+            if remaining < 0:
+                break
+            kept.append(message)
+        history = summary + kept[::-1]
+        if not self.return_messages:
+            history = get_buffer_string(
+                history, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix
+            )
+        return {self.memory_key: history}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+        with self.lock:
+            over_budget = sum(map(self._tokens, self.chat_memory.messages)) > self.budget
+            if not over_budget or self.summarizing:
+                return
+            self.summarizing = True
+        summarizers.submit(self._summarize)
+
+    def clear(self) -> None:
+        with self.lock:
+            super().clear()
+            self.moving_summary_buffer = ""
+
+    def _summarize(self):
+        try:
+            with self.lock:
+                messages = list(self.chat_memory.messages)
+                summary = self.moving_summary_buffer
+            # Keep the most recent turns verbatim, summarize everything before them.
+            remaining = int(self.budget * self.keep_ratio)
+            keep = 0
+            for message in reversed(messages):
+                remaining -= self._tokens(message)
+                if remaining < 0:
+                    break
+                keep += 1
+            old = messages[: len(messages) - keep]
+            if not old:
+                return
+            log.info(f"Summarizing {len(old)} messages to fit the {self.budget} token budget.")
+            new_summary = LLMChain(llm=self.llm, prompt=SUMMARY_PROMPT).predict(
+                summary=summary,
+                new_lines=get_buffer_string(
+                    old, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix
+                ),
+            )
+            with self.lock:
+                # The history may have been reset or extended while we were summarizing.
+                current = self.chat_memory.messages
+                if current[: len(old)] == old and self.moving_summary_buffer == summary:
+                    self.chat_memory.messages = current[len(old) :]
+                    self.moving_summary_buffer = new_summary
+        except Exception as e:
+            log.error(f"Failed to summarize conversation history: {e}")
+        finally:
+            with self.lock:
+                self.summarizing = False
+
+    def _summary_messages(self) -> List[BaseMessage]:
+        if not self.moving_summary_buffer:
+            return []
+        return [SystemMessage(content=SUMMARY_PREFIX + self.moving_summary_buffer)]
+
+    def _tokens(self, message: BaseMessage) -> int:
+        return count_tokens(message.content or "", self.model) + 4  # role and separators
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import bisect
+import logging as log
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Histogram buckets, in seconds; wide enough for anything from a cache hit to a
+# multi-step GPT-4 turn.
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, samples: int):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            self.buckets[index] += 1
+
+
+class Metrics:
+    """Thread-safe counters and latency histograms, with labels.
+
+    `render` gives the Prometheus text format, for scraping from `serve`; `summary`
+    gives averages and percentiles over the most recent `samples` observations of
+    each histogram, for the /stats admin command."""
+
+    def __init__(self, samples: int = 1000):
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        with self.lock:
+            self.counters[(name, self._labels(labels))] += value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, self._labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.samples)
+            histogram.observe(value)
+
+    def _labels(self, labels: Dict[str, str]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{self._format(labels)} {value:g}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    bucket_labels = self._format(labels + (("le", f"{bound:g}"),))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(
+                    f"{name}_bucket{self._format(labels + (('le', '+Inf'),))} {histogram.count}"
+                )
+                lines.append(f"{name}_sum{self._format(labels)} {histogram.sum:g}")
+                lines.append(f"{name}_count{self._format(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _format(self, labels: Labels) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+    def summary(self) -> dict:
+        summary = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                summary[f"{name}{self._format(labels)}"] = value
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                recent = sorted(histogram.recent)
+                summary[f"{name}{self._format(labels)}"] = {
+                    "count": histogram.count,
+                    "avg": histogram.sum / histogram.count,
+                    "p50": recent[len(recent) // 2],
+                    "p95": recent[min(len(recent) - 1, int(len(recent) * 0.95))],
+                    "max": recent[-1],
+                }
+        return summary
+
+
+registry = Metrics()
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve `registry` in the Prometheus text format at http://host:port/metrics."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes every few seconds would flood the journal
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
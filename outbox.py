@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import logging as log
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable, NamedTuple
+
+from dispatcher import Dispatcher
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class Outgoing(NamedTuple):
+    queued_at: float
+    text: str
+    progress: bool
+
+
+class Outbox:
+    """Per-recipient outbound message queue, drained in order by background senders.
+
+    Progress updates that arrive within `coalesce_window` seconds of each other are
+    merged into one message. The window is waited out on a timer, not a sender thread,
+    and ends early as soon as a reply is queued behind the progress updates. Sends that
+    fail with a 5xx (or a connection error) are retried with exponential backoff.
+    `post` never blocks on Signal I/O."""
+
+    def __init__(
+        self,
+        send_fn: Callable,
+        workers: int = 4,
+        coalesce_window: float = 1.5,
+        retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.send_fn = send_fn
+        self.coalesce_window = coalesce_window
+        self.retries = retries
+        self.backoff = backoff
+        self.senders = Dispatcher(workers=workers, max_queue=None, name="outbox")
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.scheduled = set()  # recipients with a drain queued, running or on a timer
+        self.timers = {}  # recipient -> Timer that drains its progress updates
+        self.counters = {"posted": 0, "sent": 0, "coalesced": 0, "retries": 0, "failed": 0}
+
+    def post(self, recipient: str, text: str, progress: bool = False):
+        with self.lock:
+            self.pending.setdefault(recipient, deque()).append(
+                Outgoing(time.monotonic(), text, progress)
+            )
+            self.counters["posted"] += 1
+            if recipient in self.scheduled:
+                # A reply ends the wait for more progress updates to merge.
+                timer = None if progress else self.timers.pop(recipient, None)
+                if timer is None:
+                    return
+                timer.cancel()
+            else:
+                self.scheduled.add(recipient)
+        self.senders.submit(recipient, self._drain, recipient)
+
+    def _wake(self, recipient: str, timer: threading.Timer):
+        with self.lock:
+            if self.timers.get(recipient) is not timer:
+                return  # a reply was posted and drained the queue already
+            del self.timers[recipient]
+        self.senders.submit(recipient, self._drain, recipient)
+
+    def _drain(self, recipient: str):
+        while True:
+            with self.lock:
+                queue = self.pending.get(recipient)
+                if not queue:
+                    self.pending.pop(recipient, None)
+                    self.scheduled.discard(recipient)
+                    return
+                head = queue[0]
+                wait = head.queued_at + self.coalesce_window - time.monotonic()
+                if head.progress and wait > 0 and all(m.progress for m in queue):
+                    # Give the agent a moment to emit more progress lines to merge with
+                    # this one, without holding a sender thread.
+                    timer = threading.Timer(wait, lambda: self._wake(recipient, timer))
+                    timer.daemon = True
+                    self.timers[recipient] = timer
+                    timer.start()
+                    return
+                batch = [queue.popleft()]
+                while head.progress and queue and queue[0].progress:
+                    batch.append(queue.popleft())
+                self.counters["coalesced"] += len(batch) - 1
+            self._deliver(recipient, "\n".join(m.text for m in batch))
+
+    def _deliver(self, recipient: str, text: str):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.send_fn(recipient, text)
+                if response or response.status_code < 500:
+                    with self.lock:
+                        self.counters["sent" if response else "failed"] += 1
+                    return
+            except Exception:
+                traceback.print_exc()
+            if attempt < self.retries:
+                with self.lock:
+                    self.counters["retries"] += 1
+                time.sleep(self.backoff * 2**attempt)
+        log.error(f"Giving up on message to {recipient} after {self.retries} retries.")
+        with self.lock:
+            self.counters["failed"] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+        return counters | {"queue": self.senders.stats()}
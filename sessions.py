@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import json
+import logging as log
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+STATE_DIR = os.environ.get("AGENT_C_STATE_DIR", "state")
+
+
+class SessionStore:
+    """SQLite-backed store of serialized session state, one zlib-compressed JSON blob per key."""
+
+    def __init__(self, path: str = os.path.join(STATE_DIR, "sessions.db")):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(key TEXT PRIMARY KEY, state BLOB NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self, key: str) -> Optional[dict]:
+        with self._connect() as db:
+            row = db.execute("SELECT state FROM sessions WHERE key = ?", (key,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def save(self, key: str, state: dict):
+        blob = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (key, state, updated) VALUES (?, ?, ?)",
+                (key, blob, time.time()),
+            )
+
+
+class SessionManager:
+    """LRU + idle-TTL table of live sessions, spilling their state to a SessionStore.
+
+    Sessions are created by `factory(key)` and must implement `export_state()` and
+    `load_state(state)`. State is written through to the store whenever a session is
+    released, so evicting a session (or restarting the process) never loses history."""
+
+    def __init__(
+        self,
+        factory: Callable,
+        store: SessionStore,
+        max_sessions: int = 50,
+        idle_ttl: float = 6 * 3600,
+    ):
+        self.factory = factory
+        self.store = store
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+        # key -> [session, last_used, busy count, ready]; `ready` is set once the session
+        # has been built, which happens outside the lock (see `_checkout`).
+        self.sessions = OrderedDict()
+        self.evictions = 0
+        self.rehydrations = 0
+
+    @contextmanager
+    def session(self, key: str):
+        """Check out the session for `key`, creating or rehydrating it if needed."""
+        entry = self._checkout(key)
+        try:
+            yield entry[0]
+        finally:
+            try:
+                self.store.save(key, entry[0].export_state())
+            except Exception as e:
+                log.error(f"Failed to persist session for {key}: {e}")
+            with self.lock:
+                entry[1] = time.monotonic()
+                entry[2] -= 1
+                self._evict()
+
+    def _checkout(self, key: str) -> list:
+        while True:
+            with self.lock:
+                entry = self.sessions.get(key)
+                creator = entry is None
+                if creator:
+                    # Only reserve the key here: building the session can mean importing
+                    # the agent and loading its state, and other keys shouldn't wait.
+                    entry = self.sessions[key] = [None, time.monotonic(), 0, threading.Event()]
+                self.sessions.move_to_end(key)
+                entry[2] += 1  # busy, so the placeholder is never evicted
+            if creator:
+                try:
+                    entry[0] = self._create(key)
+                except BaseException:
+                    with self.lock:
+                        if self.sessions.get(key) is entry:
+                            del self.sessions[key]
+                    raise
+                finally:
+                    entry[3].set()
+                return entry
+            entry[3].wait()
+            if entry[0] is not None:
+                return entry
+            # Whoever was building it failed and dropped the entry; try again ourselves.
+
+    def _create(self, key: str):
+        session = self.factory(key)
+        state = self.store.load(key)
+        if state is not None:
+            session.load_state(state)
+            with self.lock:
+                self.rehydrations += 1
+            log.info(f"Rehydrated session for {key}.")
+        return session
+
+    def _evict(self):
+        """Drop idle sessions past their TTL, then least recently used ones over the cap.
+        Sessions that are checked out are never evicted. Caller must hold the lock."""
+        now = time.monotonic()
+        for key, (_, last_used, busy, _) in list(self.sessions.items()):
+            over_cap = len(self.sessions) > self.max_sessions
+            if busy or not (over_cap or now - last_used > self.idle_ttl):
+                continue
+            del self.sessions[key]
+            self.evictions += 1
+            log.info(f"Evicted session for {key}.")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "live": len(self.sessions),
+                "evictions": self.evictions,
+                "rehydrations": self.rehydrations,
+            }
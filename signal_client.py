@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging as log
+import threading
+import time
+from collections import defaultdict
+from typing import NamedTuple
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Status codes worth retrying: signal-cli-rest-api returns these while signal-cli is
+# restarting or the Signal servers are throttling us.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class SignalResponse(NamedTuple):
+    status_code: int
+    text: str
+
+    def __bool__(self):
+        return self.status_code // 100 == 2
+
+
+class LatencyStats:
+    """Per-endpoint call counts and latencies, shared by the sync and async clients."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.total = defaultdict(float)
+        self.worst = defaultdict(float)
+
+    def record(self, endpoint: str, seconds: float):
+        with self.lock:
+            self.calls[endpoint] += 1
+            self.total[endpoint] += seconds
+            self.worst[endpoint] = max(self.worst[endpoint], seconds)
+        metrics.registry.observe("signal_request_seconds", seconds, endpoint=endpoint)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                endpoint: {
+                    "calls": calls,
+                    "avg": self.total[endpoint] / calls,
+                    "max": self.worst[endpoint],
+                }
+                for endpoint, calls in self.calls.items()
+            }
+
+
+class SignalClient:
+    """signal-cli-rest-api client over a pooled keep-alive `requests.Session`.
+
+    Idempotent calls are retried with exponential backoff on connection errors and
+    RETRY_STATUSES. Sends are only retried when the connection could not be made,
+    since a 5xx after the request went out may still have delivered the message."""
+
+    def __init__(
+        self,
+        api_url: str,
+        number: str,
+        pool_size: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 10,
+        send_timeout: float = 60,
+    ):
+        self.api_url = api_url
+        self.number = number
+        self.timeout = timeout
+        self.send_timeout = send_timeout
+        self.latency = LatencyStats()
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods={"GET", "PUT", "DELETE"},
+            raise_on_status=False,
+        )
+        self.session.mount(
+            api_url,
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry),
+        )
+
+    def _request(self, endpoint, method, path, timeout=None, **kwargs):
+        start = time.monotonic()
+        try:
+            return self.session.request(
+                method, self.api_url + path, timeout=timeout or self.timeout, **kwargs
+            )
+        finally:
+            self.latency.record(endpoint, time.monotonic() - start)
+
+    def send(self, recipient: str, message: str, extra_data: dict = {}) -> SignalResponse:
+        log.debug(f"Trying to text {recipient}: {message}")
+        payload = extra_data | {
+            "recipients": [recipient],
+            "message": message,
+            "number": self.number,
+        }
+        response = self._request(
+            "send", "POST", "/v2/send", json=payload, timeout=self.send_timeout
+        )
+        if response.status_code != 201:
+            log.error(
+                f"Failed to send message. Status code: [{response.status_code}], Error: [{response.text}]"
+            )
+        return SignalResponse(response.status_code, response.text)
+
+    def start_typing(self, recipient: str) -> SignalResponse:
+        return self._typing("PUT", recipient)
+
+    def stop_typing(self, recipient: str) -> SignalResponse:
+        return self._typing("DELETE", recipient)
+
+    def _typing(self, method, recipient):
+        response = self._request(
+            "typing",
+            method,
+            f"/v1/typing-indicator/{self.number}",
+            json={"recipient": recipient},
+        )
+        if response.status_code // 100 != 2:
+            log.error(
+                f"Failed to {'set' if method == 'PUT' else 'delete'} typing status. Status code: [{response.status_code}], Error: [{response.text}]"
+            )
+        return SignalResponse(response.status_code, response.text)
+
+    def receive(self) -> requests.Response:
+        """Receive messages in normal (polling) mode."""
+        return self._request("receive", "GET", f"/v1/receive/{self.number}")
+
+    def fetch_attachment(self, id: str, stream: bool = False) -> requests.Response:
+        """Fetch an attachment by string id. With `stream`, the caller must close the response."""
+        return self._request("attachment", "GET", f"/v1/attachments/{id}", stream=stream)
+
+    def stats(self) -> dict:
+        """Latency per endpoint, plus how many requests reused a pooled connection."""
+        pools = self.session.get_adapter(self.api_url).poolmanager.pools
+        connections = requests_made = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+        return {
+            "latency": self.latency.summary(),
+            "connections_opened": connections,
+            "requests": requests_made,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncSignalClient:
+    """asyncio counterpart of SignalClient, over one keep-alive aiohttp connector.
+
+    Create it inside the event loop that will use it."""
+
+    def __init__(
+        self,
+        api_url: str,
+        number: str,
+        pool_size: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 10,
+        send_timeout: float = 60,
+    ):
+        self.api_url = api_url
+        self.number = number
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.send_timeout = aiohttp.ClientTimeout(total=send_timeout)
+        self.latency = LatencyStats()
+        self.connections_opened = 0
+        self.requests = 0
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_created)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=60),
+            trace_configs=[trace],
+        )
+
+    async def _on_connection_created(self, session, context, params):
+        self.connections_opened += 1
+
+    async def _request(self, endpoint, method, path, timeout=None, idempotent=True, **kwargs):
+        start = time.monotonic()
+        try:
+            for attempt in range(self.retries + 1):
+                last = attempt == self.retries
+                try:
+                    self.requests += 1
+                    async with self.session.request(
+                        method, self.api_url + path, timeout=timeout or self.timeout, **kwargs
+                    ) as response:
+                        if idempotent and response.status in RETRY_STATUSES and not last:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, (), status=response.status
+                            )
+                        return SignalResponse(response.status, await response.text())
+                except aiohttp.ClientConnectionError:
+                    if last:
+                        raise
+                except aiohttp.ClientResponseError:
+                    pass
+                await asyncio.sleep(self.backoff * 2**attempt)
+        finally:
+            self.latency.record(endpoint, time.monotonic() - start)
+
+    async def send(self, recipient: str, message: str, extra_data: dict = {}) -> SignalResponse:
+        log.debug(f"Trying to text {recipient}: {message}")
+        payload = extra_data | {
+            "recipients": [recipient],
+            "message": message,
+            "number": self.number,
+        }
+        response = await self._request(
+            "send",
+            "POST",
+            "/v2/send",
+            json=payload,
+            timeout=self.send_timeout,
+            idempotent=False,
+        )
+        if response.status_code != 201:
+            log.error(
+                f"Failed to send message. Status code: [{response.status_code}], Error: [{response.text}]"
+            )
+        return response
+
+    async def start_typing(self, recipient: str) -> SignalResponse:
+        return await self._typing("PUT", recipient)
+
+    async def stop_typing(self, recipient: str) -> SignalResponse:
+        return await self._typing("DELETE", recipient)
+
+    async def _typing(self, method, recipient):
+        response = await self._request(
+            "typing",
+            method,
+            f"/v1/typing-indicator/{self.number}",
+            json={"recipient": recipient},
+        )
+        if response.status_code // 100 != 2:
+            log.error(
+                f"Failed to {'set' if method == 'PUT' else 'delete'} typing status. Status code: [{response.status_code}], Error: [{response.text}]"
+            )
+        return response
+
+    async def receive(self) -> SignalResponse:
+        return await self._request("receive", "GET", f"/v1/receive/{self.number}")
+
+    async def fetch_attachment(self, id: str) -> bytes:
+        start = time.monotonic()
+        try:
+            async with self.session.get(
+                f"{self.api_url}/v1/attachments/{id}", timeout=self.timeout
+            ) as response:
+                response.raise_for_status()
+                return await response.read()
+        finally:
+            self.latency.record("attachment", time.monotonic() - start)
+
+    def stats(self) -> dict:
+        return {
+            "latency": self.latency.summary(),
+            "connections_opened": self.connections_opened,
+            "requests": self.requests,
+        }
+
+    async def close(self):
+        await self.session.close()
@@ -2,14 +2,22 @@
 
 from datetime import datetime
 
-import agent_c
+import asyncio
+
+import attachments
+import dispatcher
+import metrics
+import outbox
+import sessions
+import signal_client
+import tools.cache
+import tools.registry
 import json
 import logging as log
-import requests
 import threading
+import time
 import traceback
 import websocket
-import base64
 import mimetypes
 import re
 import os
@@ -20,10 +28,70 @@ bot_number = os.environ.get("SIGNAL_BOT")
 admin = os.environ.get("SIGNAL_ADMIN")
 allowlist = os.environ.get("SIGNAL_ALLOWLIST").split(",")
 
-agents = {}
+
+def new_agent(sender):
+    # agent_c pulls in langchain and takes seconds to import, so it is imported after
+    # the websocket connects (see `warm_up`) rather than before.
+    import agent_c
+
+    return agent_c.AgentC(
+        lambda x: outgoing.post(sender, x),
+        lambda x: outgoing.post(sender, x, progress=True),
+        documents=tools.registry.module("documents").DocumentStore(sender),
+        owner=sender,
+    )
+
+
+def warm_up():
+    """Import the agent and build the shared tools in the background, so the first
+    message after a restart doesn't wait for them."""
+    started = time.monotonic()
+    try:
+        import agent_c
+
+        agent_c.shared.tools  # builds the LLM clients and imports the tool modules
+        agent_c.shared.extra_advanced_tools
+    except Exception as e:
+        log.error(f"Warm-up failed, the first turn will retry: {e}")
+        return
+    log.info(f"Agent warmed up in {time.monotonic() - started:.2f}s.")
+
+
+agents = sessions.SessionManager(
+    factory=new_agent,
+    store=sessions.SessionStore(),
+    max_sessions=int(os.environ.get("AGENT_C_MAX_SESSIONS", "50")),
+    idle_ttl=float(os.environ.get("AGENT_C_SESSION_TTL", str(6 * 3600))),
+)
+
+# Turns for the same sender run in order; different senders run concurrently.
+# With SIGNAL_ASYNC_TURNS set, turns run as AgentC.ahandle coroutines on one event loop,
+# up to that many at once, instead of on SIGNAL_WORKERS threads blocking on I/O.
+async_turns = int(os.environ.get("SIGNAL_ASYNC_TURNS", "0"))
+if async_turns:
+    workers = dispatcher.AsyncDispatcher(
+        workers=async_turns,
+        max_queue=int(os.environ.get("SIGNAL_QUEUE_DEPTH", "3")),
+        name="turns",
+    )
+else:
+    workers = dispatcher.Dispatcher(
+        workers=int(os.environ.get("SIGNAL_WORKERS", "4")),
+        max_queue=int(os.environ.get("SIGNAL_QUEUE_DEPTH", "3")),
+        name="turns",
+    )
 
 # Initialize the API URL
-api_url = "http://localhost:8080"
+api_url = os.environ.get("SIGNAL_API_URL", "http://localhost:8080")
+signal_api = signal_client.SignalClient(api_url, bot_number)
+async_signal_api = None  # created on the turn loop by the first async turn
+
+# Replies are sent in the background so agent turns never wait on Signal.
+outgoing = outbox.Outbox(
+    lambda recipient, text: send_and_load_urls(recipient, text),
+    workers=int(os.environ.get("SIGNAL_SENDERS", "4")),
+    coalesce_window=float(os.environ.get("SIGNAL_COALESCE_WINDOW", "1.5")),
+)
 
 url_pattern = re.compile(r"\bhttps?://[\w$+\-*/=\\#?&@~!%\.,:;]+")
 
@@ -33,80 +101,40 @@ def timestamp():
 
 
 def send_and_load_urls(recipient_phone_number, message):
-    urls = re.findall(url_pattern, message)
+    urls = []
+    for url in re.findall(url_pattern, message):
+        mime_type = mimetypes.guess_type(url)[0]
+        if mime_type == None or mime_type.startswith("text"):
+            continue
+        log.debug(f"Trying to fetch & encode {mime_type} from URL: {url}")
+        urls.append((url, mime_type))
     try:
-        attachments = []
-        for url in urls:
-            mime_type = mimetypes.guess_type(url)[0]
-            if mime_type == None or mime_type.startswith("text"):
-                continue
-            log.debug(f"Trying to fetch & encode {mime_type} from URL: {url}")
-            data = base64.b64encode(requests.get(url).content).decode("utf-8")
-            attachments.append(f"data:{mime_type};base64,{data}")
-
-        extra_data = {"base64_attachments": attachments} if attachments else {}
-        return send(recipient_phone_number, message, extra_data)
+        loaded = attachments.load_attachments(urls) if urls else []
     except Exception as e:
         traceback.print_exc()
         log.error(f"Failed to load URL(s) with error: {str(e)}")
-        return send(recipient_phone_number, message)
-
-
-# Send a message
-def send(recipient_phone_number, message, extra_data={}):
-    log.debug(f"Trying to text {recipient_phone_number}: {message}")
-    url = f"{api_url}/v2/send"
-    payload = extra_data | {
-        "recipients": [recipient_phone_number],
-        "message": message,
-        "number": bot_number,
-    }
-    response = requests.post(url, json=payload)
-    if response.status_code != 201:
-        log.error(
-            f"Failed to send message. Status code: [{response.status_code}], Error: [{response.text}]"
-        )
-        return False
-    return True
-
-
-def start_typing(recipient_phone_number):
-    url = f"{api_url}/v1/typing-indicator/{bot_number}"
-    payload = {"recipient": recipient_phone_number}
-    response = requests.put(url, json=payload)
-    if response.status_code // 100 != 2:
-        log.error(
-            f"Failed to set typing status. Status code: [{response.status_code}], Error: [{response.text}]"
-        )
-        return False
-    return True
-
-
-def stop_typing(recipient_phone_number):
-    url = f"{api_url}/v1/typing-indicator/{bot_number}"
-    payload = {"recipient": recipient_phone_number}
-    response = requests.delete(url, json=payload)
-    if response.status_code // 100 != 2:
-        log.error(
-            f"Failed to delete typing status. Status code: [{response.status_code}], Error: [{response.text}]"
-        )
-        return False
-    return True
-
-
-# Receive messages in normal mode
-def receive_normal():
-    url = f"{api_url}/v1/receive/{bot_number}"
-    # , headers={"Content-Type": "application/json"})
-    response = requests.get(url)
-    return response
+        loaded = []
+    extra_data = {"base64_attachments": loaded} if loaded else {}
+    return signal_api.send(recipient_phone_number, message, extra_data)
+
+
+def server_stats():
+    return (
+        workers.stats()
+        | agents.stats()
+        | {
+            "signal": signal_api.stats(),
+            "outbox": outgoing.stats(),
+            "attachment_cache": attachments.cache.stats(),
+            "tool_caches": tools.cache.all_stats(),
+        }
+        | image_job_stats()
+    )
 
 
-# Fetch an attachment by string id
-def fetch_attachment(id):
-    url = f"{api_url}/v1/attachments/{id}"
-    response = requests.get(url)
-    return response
+def image_job_stats():
+    imagejobs = tools.registry.loaded("imagejobs")
+    return {"image_jobs": imagejobs.jobs.stats()} if imagejobs else {}
 
 
 def on_error(ws, error):
@@ -119,8 +147,9 @@ def on_close(ws, status_code, msg):
 
 def on_open(ws):
     log.info("WebSocket connection established.")
+    threading.Thread(target=warm_up, daemon=True).start()
     message = "Starting server on " + timestamp()
-    send(admin, message)
+    signal_api.send(admin, message)
 
 
 # Receive messages using WebSocket
@@ -137,7 +166,7 @@ def on_message(ws, message):
         senderName = message["envelope"]["sourceName"]
         if sender == None:
             log.info(f"Received first message from a new sender: [{senderName}].")
-            send(
+            signal_api.send(
                 message["envelope"]["sourceUuid"],
                 "Hi! Since this was your first message, Signal does not allow me to do much. Please prompt me again.",
             )
@@ -147,33 +176,111 @@ def on_message(ws, message):
             log.warning(f"Received message from disallowed number: {sender}")
             return
 
-        try:
-            msg_txt = message["envelope"]["dataMessage"]["message"]
-            if "attachments" in message["envelope"]["dataMessage"]:
-                metadata = message["envelope"]["dataMessage"]["attachments"]
-                if "id" in metadata:
-                    attachment = fetch_attachment(metadata["id"])
-            log.info(f"{sender} says:" + msg_txt)
-            if sender not in agents:
-                agents[sender] = agent_c.AgentC(lambda x: send_and_load_urls(sender, x))
-
-            start_typing(sender)
-            try:
-                agents[sender].handle(msg_txt)
-            finally:
-                stop_typing(sender)
-        except Exception as e:
-            send(
+        msg_txt = message["envelope"]["dataMessage"].get("message") or ""
+        # Attachment metadata only; the files are downloaded by the turn that reads them.
+        uploads = message["envelope"]["dataMessage"].get("attachments") or []
+        if not msg_txt and not uploads:
+            return  # reactions, stickers, ...
+        log.info(f"{sender} says:" + msg_txt)
+        for upload in uploads:
+            log.info(f"{sender} attached {upload.get('filename')} ({upload.get('contentType')}).")
+
+        if sender == admin and msg_txt == "/queue":
+            signal_api.send(sender, json.dumps(server_stats(), indent=1))
+            return
+        if sender == admin and msg_txt == "/stats":
+            signal_api.send(sender, json.dumps(metrics.registry.summary(), indent=1))
+            return
+
+        turn = ahandle_message if async_turns else handle_message
+        if not workers.submit(sender, turn, sender, msg_txt, uploads):
+            signal_api.send(
                 sender,
-                "Something went wrong.\nHere's the traceback for the brave of heart:\n\n"
-                + str(e),
+                "I'm busy with your earlier messages. Please wait for me to reply before sending more.",
             )
-            raise
 
     except Exception as e:
         traceback.print_exc()
 
 
+def read_upload(sender, agent, upload):
+    """Stream an attachment into the agent's documents; returns a description of it, or
+    None after telling the sender why it couldn't be read."""
+    name = upload.get("filename") or upload["id"]
+    try:
+        with signal_api.fetch_attachment(upload["id"], stream=True) as response:
+            response.raise_for_status()
+            return agent.ingest(name, upload.get("contentType"), response.iter_content(2**16))
+    except Exception as e:
+        log.error(f"Failed to read attachment {name}: {e}")
+        outgoing.post(sender, f"📄 I couldn't read {name}: {e}.")
+        return None
+
+
+def handle_message(sender, msg_txt, uploads=()):
+    try:
+        with agents.session(sender) as agent:
+            signal_api.start_typing(sender)
+            try:
+                read = [r for r in (read_upload(sender, agent, u) for u in uploads) if r]
+                if read and not msg_txt:
+                    outgoing.post(sender, f"📄 I've read {', '.join(read)}. What would you like to know?")
+                    return
+                if read:
+                    # Only a note goes into the prompt; the agent looks things up with the
+                    # documents tool.
+                    msg_txt += f"\n\n(I've attached {', '.join(read)}; it's in your documents tool.)"
+                if msg_txt:
+                    agent.handle(msg_txt)
+            finally:
+                signal_api.stop_typing(sender)
+    except Exception as e:
+        outgoing.post(
+            sender,
+            "Something went wrong.\nHere's the traceback for the brave of heart:\n\n"
+            + str(e),
+        )
+        raise
+
+
+async def ahandle_message(sender, msg_txt, uploads=()):
+    """Async version of `handle_message`, run on the turn dispatcher's event loop."""
+    global async_signal_api
+    if async_signal_api is None:
+        async_signal_api = signal_client.AsyncSignalClient(api_url, bot_number)
+    try:
+        # Checking out a session can import agent_c and load its state from SQLite, and
+        # checking it back in saves it, so both happen off the loop.
+        session = agents.session(sender)
+        agent = await asyncio.to_thread(session.__enter__)
+        try:
+            await async_signal_api.start_typing(sender)
+            try:
+                read = []
+                for upload in uploads:
+                    description = await asyncio.to_thread(read_upload, sender, agent, upload)
+                    if description:
+                        read.append(description)
+                if read and not msg_txt:
+                    outgoing.post(sender, f"📄 I've read {', '.join(read)}. What would you like to know?")
+                    return
+                if read:
+                    msg_txt += f"\n\n(I've attached {', '.join(read)}; it's in your documents tool.)"
+                if msg_txt:
+                    await agent.ahandle(msg_txt)
+            finally:
+                await async_signal_api.stop_typing(sender)
+        finally:
+            await asyncio.to_thread(session.__exit__, None, None, None)
+    except Exception as e:
+        outgoing.post(
+            sender,
+            "Something went wrong.\nHere's the traceback for the brave of heart:\n\n"
+            + str(e),
+        )
+        raise
+
+
 def receive_bg():
     websocket_url = f"ws{api_url[4:]}/v1/receive/{bot_number}"
     ws = websocket.WebSocketApp(
@@ -186,9 +293,17 @@ def receive_bg():
     ws.run_forever(reconnect=5)
 
 
-# Start the receive_messages function in a separate thread
-receive_thread = threading.Thread(target=receive_bg)
-receive_thread.start()
+def main():
+    if os.environ.get("METRICS_PORT"):
+        metrics.serve(int(os.environ["METRICS_PORT"]))
+
+    # Start the receive_messages function in a separate thread
+    receive_thread = threading.Thread(target=receive_bg)
+    receive_thread.start()
+
+    # Wait for the WebSocket thread to end, then exit the program
+    receive_thread.join()
+
 
-# Wait for the WebSocket thread to end, then exit the program
-receive_thread.join()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import asyncio
+import weakref
+
+import aiohttp
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0 Safari/537.36"
+
+# One keep-alive client session per event loop, shared by every async tool.
+_sessions = weakref.WeakKeyDictionary()
+
+
+def session() -> aiohttp.ClientSession:
+    """The shared aiohttp session for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _sessions.get(loop)
+    if client is None or client.closed:
+        client = _sessions[loop] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=60),
+            headers={"User-Agent": USER_AGENT},
+        )
+    return client
+
+
+async def close():
+    """Close the running loop's shared session, e.g. before the loop shuts down."""
+    client = _sessions.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
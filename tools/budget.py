@@ -0,0 +1,48 @@
+import contextvars
+import os
+
+from tools.cache import DEFAULT_DB, TTLCache
+from tools.tokens import DEFAULT_MODEL, encoding
+
+# Model the current agent turn runs on; tool output is measured in its tokens.
+active_model = contextvars.ContextVar("active_model", default=DEFAULT_MODEL)
+
+PAGE_TOKENS = int(os.environ.get("TOOL_OUTPUT_TOKENS", "4000"))
+
+# Full text of paged tool outputs that have no cache of their own (e.g. transcripts),
+# so asking for the next page doesn't fetch the document again.
+documents = TTLCache(
+    "documents",
+    ttl=float(os.environ.get("DOCUMENT_CACHE_TTL", "3600")),
+    max_items=64,
+    path=DEFAULT_DB,
+)
+
+
+def count(text: str, model: str = None) -> int:
+    """Tokens `text` takes up for `model` (the active model by default). Unlike
+    `tokens.count_tokens` this isn't cached, as tool outputs can be whole documents."""
+    return len(encoding(model or active_model.get()).encode(text, disallowed_special=()))
+
+
+def page(text: str, cursor: int = 0, max_tokens: int = PAGE_TOKENS, model: str = None) -> str:
+    """Return the part of `text` starting at character `cursor` that fits in `max_tokens`
+    tokens of `model` (the active model by default), ending at a word break if possible.
+
+    If text remains, a note tells the model which cursor continues from here. Every
+    paging tool uses this, so the protocol is the same everywhere."""
+    cursor = max(0, cursor)
+    enc = encoding(model or active_model.get())
+    # A token is rarely more than a handful of characters, so this window is plenty.
+    window = text[cursor : cursor + max_tokens * 8]
+    tokens = enc.encode(window, disallowed_special=())
+    if len(tokens) <= max_tokens and cursor + len(window) >= len(text):
+        return window
+    chunk = enc.decode(tokens[:max_tokens]).rstrip("�")
+    if not window.startswith(chunk):
+        chunk = window[: len(chunk)]
+    end = max(chunk.rfind("\n"), chunk.rfind(" "))
+    if end > len(chunk) * 0.9:
+        chunk = chunk[: end + 1]
+    next_cursor = cursor + len(chunk)
+    return f"{chunk}\nPAGE WAS TRUNCATED. TO CONTINUE READING, USE CURSOR={next_cursor}."
@@ -0,0 +1,217 @@
+import asyncio
+import contextvars
+import json
+import logging as log
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+STATE_DIR = os.environ.get("AGENT_C_STATE_DIR", "state")
+DEFAULT_DB = os.path.join(STATE_DIR, "cache.db")
+
+MISSING = object()
+
+# Every cache created in this process, by name, for stats reporting.
+caches: Dict[str, "TTLCache"] = {}
+
+# `(cache name, served from cache)` for each lookup the current tool call makes. Whoever
+# wants to know (the metrics callback) sets a list here when a tool call starts.
+lookups: contextvars.ContextVar[Optional[List[tuple]]] = contextvars.ContextVar(
+    "cache_lookups", default=None
+)
+
+
+def normalize_key(*parts: Any) -> str:
+    """Cache key that ignores case and whitespace differences, e.g. in search queries."""
+    return "|".join(" ".join(str(part).lower().split()) for part in parts)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire `ttl` seconds after being set.
+
+    With `path`, entries are also written to an SQLite file so they are shared with
+    other processes and survive restarts; values must then be JSON-serializable."""
+
+    def __init__(
+        self, name: str, ttl: float, max_items: int = 128, path: Optional[str] = None
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_items = max_items
+        self.path = path
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # key -> (expires, value)
+        self.inflight: Dict[str, _Flight] = {}
+        self.ainflight: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Future] = {}
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0}
+        self.computes = 0
+        self.compute_seconds = 0.0
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with self._connect() as db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS cache (name TEXT NOT NULL, key TEXT NOT NULL, "
+                    "value TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (name, key))"
+                )
+        caches[name] = self
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None and entry[0] > now:
+                self.items.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[1]
+            self.items.pop(key, None)
+        if self.path:
+            with self._connect() as db:
+                row = db.execute(
+                    "SELECT value, expires FROM cache WHERE name = ? AND key = ? AND expires > ?",
+                    (self.name, key, now),
+                ).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                with self.lock:
+                    self._remember(key, row[1], value)
+                    self.counters["disk_hits"] += 1
+                return value
+        with self.lock:
+            self.counters["misses"] += 1
+        return default
+
+    def set(self, key: str, value: Any):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, expires, value)
+        if self.path:
+            with self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                    (self.name, key, json.dumps(value), expires),
+                )
+                db.execute(
+                    "DELETE FROM cache WHERE name = ? AND expires <= ?", (self.name, time.time())
+                )
+
+    def get_or_compute(
+        self, key: str, compute: Callable[[], Any], cacheable: Callable[[Any], bool] = None
+    ) -> Any:
+        """Return the cached value for `key`, or compute and cache it.
+
+        Concurrent callers missing on the same key wait for a single `compute()` call
+        and share its result (or its exception) instead of computing it again. Results
+        for which `cacheable` returns False are shared but not cached."""
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            self._record(True)
+            return value
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+            else:
+                self.counters["coalesced"] += 1
+        self._record(not leader)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        start = time.monotonic()
+        try:
+            flight.value = compute()
+            if cacheable is None or cacheable(flight.value):
+                self.set(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.computes += 1
+                self.compute_seconds += time.monotonic() - start
+                del self.inflight[key]
+            flight.done.set()
+
+    async def aget_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        cacheable: Callable[[Any], bool] = None,
+    ) -> Any:
+        """Async counterpart of `get_or_compute`, deduplicating concurrent coroutines."""
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            self._record(True)
+            return value
+        # Futures belong to the loop that made them, so flights are only shared within one.
+        flight_key = (asyncio.get_running_loop(), key)
+        flight = self.ainflight.get(flight_key)
+        self._record(flight is not None)
+        if flight is not None:
+            with self.lock:
+                self.counters["coalesced"] += 1
+            return await asyncio.shield(flight)
+        # Computed in a task of its own, so cancelling whichever caller started it
+        # doesn't cancel the callers waiting on the same result.
+        flight = self.ainflight[flight_key] = asyncio.ensure_future(
+            self._acompute(flight_key, compute, cacheable)
+        )
+        flight.add_done_callback(lambda f: f.cancelled() or f.exception())  # mark retrieved
+        return await asyncio.shield(flight)
+
+    async def _acompute(self, flight_key, compute, cacheable) -> Any:
+        start = time.monotonic()
+        try:
+            value = await compute()
+            if cacheable is None or cacheable(value):
+                self.set(flight_key[1], value)
+            return value
+        finally:
+            with self.lock:
+                self.computes += 1
+                self.compute_seconds += time.monotonic() - start
+            del self.ainflight[flight_key]
+
+    def _record(self, served: bool):
+        recorded = lookups.get()
+        if recorded is not None:
+            recorded.append((self.name, served))
+
+    def _remember(self, key, expires, value):
+        self.items[key] = (expires, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters) | {"items": len(self.items)}
+            average_compute = self.compute_seconds / self.computes if self.computes else 0
+        served = stats["hits"] + stats["disk_hits"] + stats["coalesced"]
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0
+        # Estimated from the average time a miss took to compute.
+        stats["saved_seconds"] = served * average_compute
+        return stats
+
+
+def all_stats() -> dict:
+    return {name: cache.stats() for name, cache in caches.items()}
@@ -0,0 +1,363 @@
+import ast
+import logging as log
+import math
+import operator
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+MAX_EXPONENT = 1000
+MAX_RESULT_BITS = 10000
+MAX_FACTORIAL = 1000
+
+
+class CalcError(ValueError):
+    """The input isn't something the local evaluator can answer."""
+
+
+def _aggregate(fn):
+    """`fn` over one list argument, or over all the arguments: max([1, 2]) or max(1, 2)."""
+    return lambda *args: fn(args[0] if len(args) == 1 else np.array(args, dtype=float))
+
+
+def _log(x, base=None):
+    return np.log(x) if base is None else np.log(x) / np.log(base)
+
+
+def _factorial(x):
+    values = np.asarray(x)
+    if np.any(values > MAX_FACTORIAL):
+        raise CalcError(f"factorial above {MAX_FACTORIAL}")
+    if np.any(values != np.floor(values)):
+        raise CalcError("factorial of a non-integer")
+    if isinstance(x, np.ndarray):
+        return np.array([math.factorial(int(v)) for v in x], dtype=float)
+    return math.factorial(int(x))
+
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau, "inf": math.inf}
+# NumPy functions work on plain numbers and elementwise on lists alike.
+FUNCTIONS = {
+    "sqrt": np.sqrt,
+    "cbrt": np.cbrt,
+    "exp": np.exp,
+    "log": _log,
+    "ln": np.log,
+    "log10": np.log10,
+    "log2": np.log2,
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "asin": np.arcsin,
+    "acos": np.arccos,
+    "atan": np.arctan,
+    "sinh": np.sinh,
+    "cosh": np.cosh,
+    "tanh": np.tanh,
+    "degrees": np.degrees,
+    "radians": np.radians,
+    "abs": np.abs,
+    "round": np.round,
+    "floor": np.floor,
+    "ceil": np.ceil,
+    "factorial": _factorial,
+    "gcd": np.gcd,
+    "lcm": np.lcm,
+    "hypot": np.hypot,
+    "min": _aggregate(np.min),
+    "max": _aggregate(np.max),
+    "sum": _aggregate(np.sum),
+    "prod": _aggregate(np.prod),
+    "product": _aggregate(np.prod),
+    "mean": _aggregate(np.mean),
+    "average": _aggregate(np.mean),
+    "avg": _aggregate(np.mean),
+    "median": _aggregate(np.median),
+    "std": _aggregate(np.std),
+    "var": _aggregate(np.var),
+    "cumsum": np.cumsum,
+    "diff": np.diff,
+}
+
+# Unit -> (dimension, size in the dimension's base unit).
+UNITS = {}
+for dimension, units in {
+    "length": {
+        ("m", "meter", "meters", "metre", "metres"): 1,
+        ("km", "kilometer", "kilometers", "kilometre", "kilometres"): 1000,
+        ("cm", "centimeter", "centimeters"): 0.01,
+        ("mm", "millimeter", "millimeters"): 0.001,
+        ("mi", "mile", "miles"): 1609.344,
+        ("yd", "yard", "yards"): 0.9144,
+        ("ft", "foot", "feet"): 0.3048,
+        ("in", "inch", "inches"): 0.0254,
+        ("nmi",): 1852,
+    },
+    "mass": {
+        ("kg", "kilogram", "kilograms", "kilo", "kilos"): 1,
+        ("g", "gram", "grams"): 0.001,
+        ("mg", "milligram", "milligrams"): 1e-6,
+        ("t", "tonne", "tonnes"): 1000,
+        ("lb", "lbs", "pound", "pounds"): 0.45359237,
+        ("oz", "ounce", "ounces"): 0.028349523125,
+        ("st", "stone", "stones"): 6.35029318,
+    },
+    "time": {
+        ("s", "sec", "secs", "second", "seconds"): 1,
+        ("ms", "millisecond", "milliseconds"): 0.001,
+        ("min", "mins", "minute", "minutes"): 60,
+        ("h", "hr", "hrs", "hour", "hours"): 3600,
+        ("day", "days"): 86400,
+        ("week", "weeks"): 604800,
+        ("year", "years"): 31557600,
+    },
+    "volume": {
+        ("l", "liter", "liters", "litre", "litres"): 1,
+        ("ml", "milliliter", "milliliters", "millilitre", "millilitres"): 0.001,
+        ("gal", "gallon", "gallons"): 3.785411784,
+        ("qt", "quart", "quarts"): 0.946352946,
+        ("pt", "pint", "pints"): 0.473176473,
+        ("cup", "cups"): 0.2365882365,
+        ("floz",): 0.0295735295625,
+    },
+    "speed": {
+        ("m/s",): 1,
+        ("km/h", "kmh", "kph"): 1 / 3.6,
+        ("mph",): 0.44704,
+        ("kn", "knot", "knots"): 1852 / 3600,
+    },
+    "data": {
+        ("b", "byte", "bytes"): 1,
+        ("kb",): 1e3,
+        ("mb",): 1e6,
+        ("gb",): 1e9,
+        ("tb",): 1e12,
+        ("kib",): 2**10,
+        ("mib",): 2**20,
+        ("gib",): 2**30,
+        ("tib",): 2**40,
+    },
+}.items():
+    for names, size in units.items():
+        for name in names:
+            UNITS[name] = (dimension, size)
+# Temperatures need an offset as well, so they convert through kelvin.
+TEMPERATURES = {
+    "c": (lambda c: c + 273.15, lambda k: k - 273.15),
+    "celsius": (lambda c: c + 273.15, lambda k: k - 273.15),
+    "f": (lambda f: (f - 32) * 5 / 9 + 273.15, lambda k: (k - 273.15) * 9 / 5 + 32),
+    "fahrenheit": (lambda f: (f - 32) * 5 / 9 + 273.15, lambda k: (k - 273.15) * 9 / 5 + 32),
+    "k": (lambda k: k, lambda k: k),
+    "kelvin": (lambda k: k, lambda k: k),
+}
+
+CONVERSION = re.compile(r"^(?P<value>.+?)\s*(?P<src>[a-z°/]+)\s+(?:to|in|into|as)\s+(?P<dst>[a-z°/]+)$")
+PREFIX = re.compile(r"^(?:what\s+is|what's|whats|calculate|compute|evaluate|convert|solve)\s+")
+AGGREGATE_OF = re.compile(r"^(?P<fn>[a-z]+)\s+of\s+(?P<args>.+)$")
+NUMBER_WITH_COMMAS = re.compile(r"(?<![\d.])\d+(?:,\d+)+")
+THOUSANDS = re.compile(r"\d{1,3}(?:,\d{3})+")
+
+
+def strip_thousands(text: str, in_list: bool) -> str:
+    """Remove thousands separators ("1,000,000"), or raise CalcError where a comma
+    could be either that, a decimal comma or a list separator: "1,5" or, in a list
+    without spaces after its commas, "100,200"."""
+    spaced = in_list and re.search(r",\s", text)
+
+    def fix(match):
+        run = match.group()
+        grouped = THOUSANDS.fullmatch(run)
+        if in_list and not spaced:
+            if grouped:
+                raise CalcError(f"ambiguous commas in {run!r}")
+            return run  # list separators: "1,2,3"
+        if not grouped:
+            raise CalcError(f"ambiguous commas in {run!r}")
+        return run.replace(",", "")
+
+    return NUMBER_WITH_COMMAS.sub(fix, text)
+
+
+def normalize(question: str) -> str:
+    text = question.strip().lower()
+    text = PREFIX.sub("", text).rstrip("?=. ")
+    for symbol, replacement in (("×", "*"), ("÷", "/"), ("−", "-"), ("^", "**"), ("°", "")):
+        text = text.replace(symbol, replacement)
+    text = re.sub(r"(?<=\d)\s*x\s*(?=\d)", "*", text)
+    match = AGGREGATE_OF.match(text)
+    aggregate = match is not None and match["fn"] in FUNCTIONS
+    in_list = aggregate or "[" in text or re.search(r"[a-z]\s*\(", text) is not None
+    text = strip_thousands(text, in_list)
+    if aggregate:
+        # "mean of 1, 2, 3" -> mean([1, 2, 3])
+        match = AGGREGATE_OF.match(text)
+        args = match["args"].strip("[]() ")
+        return f"{match['fn']}([{args}])"
+    text = re.sub(r"(\d+(?:\.\d+)?)\s*%\s*of\b", r"(\1/100)*", text)
+    # "200 + 15%" means 15% of 200, as on a pocket calculator.
+    text = re.sub(r"^(.+?)\s*([+-])\s*(\d+(?:\.\d+)?)\s*%$", r"(\1)*(1\2\3/100)", text)
+    return re.sub(r"(\d+(?:\.\d+)?)\s*%", r"(\1/100)", text)
+
+
+def _eval(node: ast.AST) -> Any:
+    if isinstance(node, ast.Expression):
+        return _eval(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.List):
+        return np.array([_eval(element) for element in node.elts], dtype=float)
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        left, right = _eval(node.left), _eval(node.right)
+        if isinstance(node.op, ast.Pow) and (
+            np.max(np.abs(right)) > MAX_EXPONENT
+            or isinstance(left, int) and left.bit_length() * abs(right) > MAX_RESULT_BITS
+        ):
+            raise CalcError("result too large")
+        return OPERATORS[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        return UNARY_OPERATORS[type(node.op)](_eval(node.operand))
+    if isinstance(node, ast.Name) and node.id in CONSTANTS:
+        return CONSTANTS[node.id]
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id in FUNCTIONS
+        and not node.keywords
+    ):
+        return FUNCTIONS[node.func.id](*(_eval(arg) for arg in node.args))
+    raise CalcError(f"unsupported expression: {type(node).__name__}")
+
+
+def _format(value: Any) -> str:
+    if isinstance(value, np.ndarray) and value.ndim > 0:
+        return "[" + ", ".join(_format(v) for v in value.tolist()) + "]"
+    if isinstance(value, (np.ndarray, np.generic)):
+        value = value.item()
+    if isinstance(value, int):
+        # Products aren't capped while evaluating, and str() refuses huge integers.
+        if value.bit_length() > MAX_RESULT_BITS:
+            raise CalcError("result too large")
+        return str(value)
+    if not isinstance(value, float) or not math.isfinite(value):
+        raise CalcError(f"no finite real result: {value}")
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.12g}"
+
+
+def evaluate_expression(expression: str) -> Any:
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise CalcError(f"not an expression: {expression!r}") from e
+    try:
+        with np.errstate(all="ignore"):
+            return _eval(tree)
+    except (ArithmeticError, TypeError, ValueError) as e:
+        raise CalcError(str(e)) from e
+
+
+def convert(value: Any, src: str, dst: str) -> Any:
+    if src in TEMPERATURES and dst in TEMPERATURES:
+        return TEMPERATURES[dst][1](TEMPERATURES[src][0](value))
+    if src not in UNITS or dst not in UNITS or UNITS[src][0] != UNITS[dst][0]:
+        raise CalcError(f"can't convert {src} to {dst}")
+    return value * UNITS[src][1] / UNITS[dst][1]
+
+
+def evaluate(question: str) -> str:
+    """Answer `question` locally in LLMMathChain's "Answer: ..." format, or raise
+    CalcError if it's not plain math, e.g. a word problem.
+
+    Handles arithmetic, percentages ("15% of 80", "200 + 15%"), math and statistics
+    functions, lists evaluated elementwise ("sqrt([4, 9])", "mean of 1, 2, 3"), and
+    unit conversions ("5 km to miles", "100 f in c")."""
+    text = normalize(question)
+    match = CONVERSION.match(text)
+    if match and (match["src"] in UNITS or match["src"] in TEMPERATURES):
+        value = convert(evaluate_expression(match["value"]), match["src"], match["dst"])
+        return f"Answer: {_format(value)} {match['dst']}"
+    return f"Answer: {_format(evaluate_expression(text))}"
+
+
+class Calculator:
+    """Calculator that answers what `evaluate` can locally, in microseconds, and only
+    asks `fallback` (LLMMathChain) for the rest. Logs its hit rate and an estimate of
+    the time saved, based on how long fallback calls take."""
+
+    def __init__(
+        self,
+        fallback: Callable[[str], str],
+        afallback: Callable[[str], Awaitable[str]],
+    ):
+        self.fallback = fallback
+        self.afallback = afallback
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fallback_seconds = 0.0
+
+    def run(self, question: str) -> str:
+        started = time.monotonic()
+        try:
+            answer = evaluate(question)
+        except CalcError as e:
+            log.info(f"Calculator falling back to the LLM ({e}).")
+            answer = self.fallback(question)
+            self._record(False, time.monotonic() - started)
+            return answer
+        self._record(True, time.monotonic() - started)
+        return answer
+
+    async def arun(self, question: str) -> str:
+        started = time.monotonic()
+        try:
+            answer = evaluate(question)
+        except CalcError as e:
+            log.info(f"Calculator falling back to the LLM ({e}).")
+            answer = await self.afallback(question)
+            self._record(False, time.monotonic() - started)
+            return answer
+        self._record(True, time.monotonic() - started)
+        return answer
+
+    def _record(self, hit: bool, seconds: float):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.fallback_seconds += seconds
+            stats = self.stats()
+        if hit:
+            log.info(
+                f"Calculator answered locally in {seconds * 1000:.2f}ms; "
+                f"hit rate {stats['hit_ratio']:.0%}, ~{stats['saved_seconds']:.1f}s saved so far."
+            )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        fallback_avg = self.fallback_seconds / self.misses if self.misses else 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "fallback_avg": fallback_avg,
+            "saved_seconds": self.hits * fallback_avg,
+        }
+
@@ -0,0 +1,260 @@
+import asyncio
+import logging as log
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Iterable, List, Tuple, Type
+
+from langchain.tools.base import BaseTool
+from pydantic import BaseModel, Field
+
+from tools import budget
+from tools.cache import STATE_DIR
+from tools.reader import extract, extract_text_only, terminate_pool
+from tools.research import rank_passages, split_passages
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+MAX_UPLOAD_BYTES = int(os.environ.get("DOCUMENT_MAX_MB", "25")) * 2**20
+# Passages kept per session; the oldest documents are dropped to stay under it.
+MAX_SESSION_PASSAGES = int(os.environ.get("DOCUMENT_MAX_PASSAGES", "5000"))
+DEFAULT_DB = os.path.join(STATE_DIR, "documents.db")
+
+# PDF parsing is CPU-bound and can take a minute on a long scan-heavy file, so it gets
+# its own process pool rather than holding up page extraction in the reader's.
+INGEST_WORKERS = int(os.environ.get("DOCUMENT_WORKERS", "2"))
+INGEST_TIMEOUT = float(os.environ.get("DOCUMENT_EXTRACT_TIMEOUT", "120"))
+
+_ingest_pool = None
+_ingest_pool_lock = threading.Lock()
+
+TEXT_EXTENSIONS = (".txt", ".md", ".csv", ".json", ".xml", ".log", ".py", ".yaml", ".yml")
+
+
+def kind(name: str, mime_type: str) -> str:
+    """Which extractor reads an upload: "pdf", "html", "text", or None if none can."""
+    name, mime_type = name.lower(), (mime_type or "").lower()
+    if mime_type == "application/pdf" or name.endswith(".pdf"):
+        return "pdf"
+    if mime_type in ("text/html", "application/xhtml+xml") or name.endswith((".html", ".htm")):
+        return "html"
+    if mime_type.startswith("text/") or mime_type == "application/json" or name.endswith(TEXT_EXTENSIONS):
+        return "text"
+    return None
+
+
+def extract_file(path: str, file_kind: str) -> str:
+    """Text of the file at `path`; runs in the ingestion process pool."""
+    if file_kind == "pdf":
+        from pdfminer.high_level import extract_text
+
+        return extract_text(path)
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    if file_kind == "html":
+        return extract(text) or extract_text_only(text)
+    return text
+
+
+def ingest_pool():
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is None and INGEST_WORKERS > 0:
+            _ingest_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+        return _ingest_pool
+
+
+def extract_upload(path: str, file_kind: str, timeout: float = INGEST_TIMEOUT) -> str:
+    pool = ingest_pool()
+    if pool is None:
+        return extract_file(path, file_kind)
+    try:
+        return pool.submit(extract_file, path, file_kind).result(timeout=timeout)
+    except TimeoutError:
+        # Otherwise the worker keeps parsing and one of the pool's slots is gone for good.
+        reset_ingest_pool(pool, "timed out")
+        raise ValueError(f"reading it took longer than {timeout:.0f}s")
+    except BrokenProcessPool:
+        reset_ingest_pool(pool)
+        raise ValueError("the reader crashed on it")
+
+
+def reset_ingest_pool(pool, reason: str = "broke"):
+    global _ingest_pool
+    log.error(f"Ingestion pool {reason}, restarting it.")
+    with _ingest_pool_lock:
+        if _ingest_pool is pool:
+            _ingest_pool = None
+    terminate_pool(pool)
+
+
+def save_upload(chunks: Iterable[bytes], max_bytes: int = MAX_UPLOAD_BYTES) -> str:
+    """Write streamed `chunks` to a temporary file and return its path; the caller
+    removes it. Raises ValueError past `max_bytes`, so uploads never sit in memory."""
+    size = 0
+    with tempfile.NamedTemporaryFile(prefix="upload-", delete=False) as f:
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"it is larger than {max_bytes // 2**20}MB")
+                f.write(chunk)
+        except BaseException:
+            os.remove(f.name)
+            raise
+    return f.name
+
+
+class DocumentStore:
+    """One session's uploaded documents, split into passages in SQLite.
+
+    Passages are ranked against a query by the documents tool, so the agent only ever
+    sees the relevant parts of an upload rather than the whole file."""
+
+    def __init__(self, owner: str, path: str = DEFAULT_DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.owner = owner
+        self.path = path
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS passages (owner TEXT NOT NULL, name TEXT NOT NULL, "
+                "seq INTEGER NOT NULL, text TEXT NOT NULL, added REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS passages_owner ON passages (owner, name, seq)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, name: str, text: str) -> int:
+        """Store `text` as document `name`, replacing any earlier upload of that name.
+        Returns the number of passages kept."""
+        passages = split_passages(text)[:MAX_SESSION_PASSAGES]
+        with self._connect() as db:
+            db.execute("DELETE FROM passages WHERE owner = ? AND name = ?", (self.owner, name))
+            stored = db.execute(
+                "SELECT name, COUNT(*) FROM passages WHERE owner = ? GROUP BY name ORDER BY MIN(added)",
+                (self.owner,),
+            ).fetchall()
+            total = sum(count for _, count in stored) + len(passages)
+            for old, count in stored:
+                if total <= MAX_SESSION_PASSAGES:
+                    break
+                log.info(f"Dropping document {old!r} of {self.owner} to make room for {name!r}.")
+                db.execute("DELETE FROM passages WHERE owner = ? AND name = ?", (self.owner, old))
+                total -= count
+            now = time.time()
+            db.executemany(
+                "INSERT INTO passages (owner, name, seq, text, added) VALUES (?, ?, ?, ?, ?)",
+                [(self.owner, name, i, p, now) for i, p in enumerate(passages)],
+            )
+        return len(passages)
+
+    def documents(self) -> List[Tuple[str, int, int]]:
+        """`(name, passages, characters)` of each document, oldest first."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT name, COUNT(*), SUM(LENGTH(text)) FROM passages WHERE owner = ? "
+                "GROUP BY name ORDER BY MIN(added)",
+                (self.owner,),
+            ).fetchall()
+
+    def passages(self, name: str = None) -> List[Tuple[str, str]]:
+        """`(document name, passage)` pairs in reading order, for one document or all."""
+        query = "SELECT name, text FROM passages WHERE owner = ?"
+        args = (self.owner,)
+        if name:
+            query, args = query + " AND name = ?", args + (name,)
+        with self._connect() as db:
+            return db.execute(query + " ORDER BY added, name, seq", args).fetchall()
+
+    def search(self, query: str, name: str = None, max_tokens: int = budget.PAGE_TOKENS) -> str:
+        """The passages most relevant to `query`, within `max_tokens`, tagged with
+        their document's name."""
+        ranked = rank_passages(query, self.passages(name), text=lambda p: p[1])
+        results, tokens = [], 0
+        for document, passage in ranked:
+            size = budget.count(passage)
+            if tokens + size > max_tokens:
+                break
+            results.append(f"[{document}] {passage}")
+            tokens += size
+        if not results:
+            return f"Nothing in the uploaded documents matches {query!r}."
+        return "\n\n".join(results)
+
+    def read(self, name: str, cursor: int = 0) -> str:
+        """Document `name` from character `cursor`, one page at a time."""
+        passages = self.passages(name)
+        if not passages:
+            return f"There is no uploaded document named {name!r}."
+        return budget.page("\n\n".join(p for _, p in passages), cursor)
+
+    def clear(self):
+        with self._connect() as db:
+            db.execute("DELETE FROM passages WHERE owner = ?", (self.owner,))
+
+
+def ingest(store: DocumentStore, name: str, mime_type: str, chunks: Iterable[bytes]) -> str:
+    """Stream an upload to disk, extract its text in the ingestion pool and add it to
+    `store`. Returns a short description of what was read; raises ValueError for
+    uploads that can't be read."""
+    file_kind = kind(name, mime_type)
+    if file_kind is None:
+        raise ValueError(f"I can only read PDF, HTML and text files, not {mime_type or name}")
+    started = time.monotonic()
+    path = save_upload(chunks)
+    try:
+        text = extract_upload(path, file_kind)
+    finally:
+        os.remove(path)
+    if not text or not text.strip():
+        raise ValueError("I found no text in it" + (" (is it a scan?)" if file_kind == "pdf" else ""))
+    passages = store.add(name, text)
+    log.info(f"Ingested {name!r}: {len(text)} chars, {passages} passages in {time.monotonic() - started:.2f}s.")
+    return f"{name!r} ({len(text):,} characters)"
+
+
+class DocumentsInput(BaseModel):
+    query: str = Field(
+        default="",
+        description="What to look for in the uploaded documents. Leave empty to list them, "
+        "or to read the document named in `document` from the start.",
+    )
+    document: str = Field(default="", description="Only use the document with this name")
+    cursor: int = Field(
+        default=0,
+        description="When reading a whole document, start from this character. "
+        "Use when the first response was truncated and you want to continue reading.",
+    )
+
+
+class DocumentsTool(BaseTool):
+    """Searches or pages through the files the user uploaded in this session."""
+
+    name: str = "documents"
+    args_schema: Type[BaseModel] = DocumentsInput
+    description: str = "Useful for answering questions about files the user sent you \
+        (PDFs, web pages, text files). With a query, returns the most relevant passages of \
+        the uploaded documents; with only a document name, reads that document page by page; \
+        with neither, lists the documents."
+    store: Any  # DocumentStore of the session
+
+    def _run(self, query: str = "", document: str = "", cursor: int = 0) -> str:
+        if query:
+            return self.store.search(query, document or None)
+        if document:
+            return self.store.read(document, cursor)
+        documents = self.store.documents()
+        if not documents:
+            return "The user hasn't uploaded any documents."
+        return "Uploaded documents:\n" + "\n".join(
+            f"{name} ({characters:,} characters)" for name, _, characters in documents
+        )
+
+    async def _arun(self, query: str = "", document: str = "", cursor: int = 0) -> str:
+        # SQLite and BM25 ranking are both blocking.
+        return await asyncio.to_thread(self._run, query, document, cursor)
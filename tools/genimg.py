@@ -1,19 +1,31 @@
 #! /usr/bin/python3
 
 import logging as log
+import os
+from functools import lru_cache
 from typing import Callable
 
-import replicate
-
 from langchain import PromptTemplate, LLMChain
 from langchain.chat_models import ChatOpenAI
 
+from tools.cache import DEFAULT_DB, TTLCache, normalize_key
+
 log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # k_diffuser_model = "stability-ai/stable-diffusion:db21e45d3f7023abc2a46ee38a23973f6dce16bb082a930b0c49861f96d1e5bf"
 k_diffuser_model = (
     "stability-ai/sdxl:2f779eb9b23b34fe171f8eaa021b8261566f0d2c10cd2674063e7dbcd351509e"
 )
+replicate_api = "https://api.replicate.com/v1"
+
+# Curated prompts by normalized user input. Retries and "another one" of the same idea
+# then skip the GPT-4 call with its long few-shot template.
+prompt_cache = TTLCache(
+    "image_prompts",
+    ttl=float(os.environ.get("IMG_PROMPT_CACHE_TTL", str(30 * 24 * 3600))),
+    max_items=512,
+    path=DEFAULT_DB,
+)
 
 img_prompt_template = """
 You are an AI prompt generator for a generative tool called "Stable Diffusion". Stable Diffusion
@@ -146,28 +158,44 @@ fused fingers, too many fingers, long neck
 """
 
 
+def sdxl_input(prompt: str, negative_prompt: str = "") -> dict:
+    return {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "scheduler": "DDIM",
+        # "image_dimensions": "512x512",
+        # "num_inference_steps": 35,
+        # "guidance_scale": 8,
+        "refine": "expert_ensemble_refiner",
+    }
+
+
 def genimg_raw(prompt: str, negative_prompt: str = "") -> str:
+    import replicate  # only this blocking path uses the client library
+
     return replicate.run(
         model_version=k_diffuser_model,
-        input={
-            "prompt": prompt,
-            "negative_prompt": negative_prompt,
-            "scheduler": "DDIM",
-            # "image_dimensions": "512x512",
-            # "num_inference_steps": 35,
-            # "guidance_scale": 8,
-            "refine": "expert_ensemble_refiner",
-        },
+        input=sdxl_input(prompt, negative_prompt),
     )[0]
 
 
-conservative_llm = ChatOpenAI(temperature=0.1, model="gpt-4")
-img_prompt_chain = LLMChain(
-    llm=conservative_llm, prompt=PromptTemplate.from_template(img_prompt_template)
-)
+@lru_cache(maxsize=None)
+def img_prompt_chain() -> LLMChain:
+    """The prompt curation chain, built on first use rather than at import."""
+    return LLMChain(
+        llm=ChatOpenAI(temperature=0.1, model="gpt-4"),
+        prompt=PromptTemplate.from_template(img_prompt_template),
+    )
 
 
-def genimg_curated(main_prompt: str, logger: Callable = log.info) -> str:
-    curated_prompt = img_prompt_chain(main_prompt)["text"]
+def curate_prompt(main_prompt: str, logger: Callable = log.info) -> str:
+    curated_prompt = prompt_cache.get_or_compute(
+        normalize_key(main_prompt), lambda: img_prompt_chain()(main_prompt)["text"]
+    )
     logger(f"🪄🪄 Using curated image prompt: {curated_prompt}")
-    return genimg_raw(curated_prompt, negative_prompt=default_negative_prompt)
+    return curated_prompt
+
+
+def genimg_curated(main_prompt: str, logger: Callable = log.info) -> str:
+    return genimg_raw(curate_prompt(main_prompt, logger), negative_prompt=default_negative_prompt)
+
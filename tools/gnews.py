@@ -1,18 +1,34 @@
 #! /usr/bin/python3
 
+import asyncio
 import logging as log
 import os
 import requests
 import json
+import aiohttp
+from functools import lru_cache
 from typing import Dict, Any, Type
 from pydantic import BaseModel, Field
 from langchain.tools.base import BaseTool
 from langchain.chat_models import ChatOpenAI
 from langchain.agents import initialize_agent, AgentType
 
+from tools import aio, budget
+from tools.cache import DEFAULT_DB, TTLCache, normalize_key
+
 log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 GNEWS_API_KEY = os.getenv("GNEWS_API_KEY")
+GNEWS_TIMEOUT = float(os.getenv("GNEWS_TIMEOUT", "15"))
+
+# Headlines change often, so they are only cached briefly; this mostly dedupes repeat
+# calls within one agent turn and across users, and saves GNews quota.
+headlines_cache = TTLCache(
+    "headlines",
+    ttl=float(os.getenv("HEADLINES_CACHE_TTL", "600")),
+    max_items=32,
+    path=DEFAULT_DB,
+)
 
 
 class HeadlinesInput(BaseModel):
@@ -27,6 +43,11 @@ class HeadlinesInput(BaseModel):
         description="""Country code to fetch the headlines for. 'in' for India, \
         'us' for United States, 'gb' for United Kingdom. DO NOT USE ANY OTHER COUNTRY CODE.""",
     )
+    cursor: int = Field(
+        default=0,
+        description="Start reading the results from this character. "
+        "Use when the first response was truncated and you want to continue reading.",
+    )
 
 
 class HeadlinesTool(BaseTool):
@@ -42,6 +63,7 @@ class HeadlinesTool(BaseTool):
         self,
         news_category: str = "general",
         country: str = "in",
+        cursor: int = 0,
         # start_timestamp: str = None,
         # end_timestamp: str = None,
     ) -> str:
@@ -50,29 +72,98 @@ class HeadlinesTool(BaseTool):
 
         Returns:
         str: Json string that contains the results of the query."""
+        try:
+            headlines = headlines_cache.get_or_compute(
+                normalize_key(news_category, country),
+                lambda: self._fetch(news_category, country),
+            )
+        except requests.RequestException as e:
+            return f"Couldn't fetch the headlines: {e}"
+        return budget.page(self._compact(headlines), cursor)
+
+    def _fetch(self, news_category: str, country: str) -> str:
         log.info(f"Fetching news for category=[{news_category}], country=[{country}].")
-        return requests.get(
+        response = requests.get(
             "https://gnews.io/api/v4/top-headlines",
-            params={
-                "category": news_category,
-                "lang": "en",
-                "country": country,
-                "max": 10,
-                "apikey": GNEWS_API_KEY,
-                "from": None,
-                "to": None,
-            },  # unused: `q`
-        ).content
+            params=self._params(news_category, country),
+            timeout=GNEWS_TIMEOUT,
+        )
+        # Raising keeps errors (quota, bad key, outages) out of the cache.
+        response.raise_for_status()
+        return response.text
 
     async def _arun(
         self,
         news_category: str = "general",
         country: str = "in",
+        cursor: int = 0,
         # start_timestamp: str = None,
         # end_timestamp: str = None,
     ) -> str:
-        raise NotImplementedError
+        try:
+            headlines = await headlines_cache.aget_or_compute(
+                normalize_key(news_category, country),
+                lambda: self._afetch(news_category, country),
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return f"Couldn't fetch the headlines: {str(e) or 'timed out'}"
+        return budget.page(self._compact(headlines), cursor)
+
+    async def _afetch(self, news_category: str, country: str) -> str:
+        log.info(f"Fetching news for category=[{news_category}], country=[{country}].")
+        async with aio.session().get(
+            "https://gnews.io/api/v4/top-headlines",
+            params=self._params(news_category, country),
+            timeout=aiohttp.ClientTimeout(total=GNEWS_TIMEOUT),
+        ) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    def _compact(self, headlines: str) -> str:
+        """Only the fields worth spending tokens on, one article per line. The GNews
+        response also carries image URLs and a truncated copy of each article."""
+        try:
+            articles = json.loads(headlines)["articles"]
+        except (ValueError, KeyError, TypeError):
+            return headlines  # most likely an error message, pass it on as is
+        return "\n".join(
+            json.dumps(
+                {
+                    "title": article.get("title"),
+                    "description": article.get("description"),
+                    "url": article.get("url"),
+                    "publishedAt": article.get("publishedAt"),
+                    "source": (article.get("source") or {}).get("name"),
+                },
+                ensure_ascii=False,
+            )
+            for article in articles
+        )
 
+    def _params(self, news_category: str, country: str) -> Dict[str, Any]:
+        return {
+            "category": news_category,
+            "lang": "en",
+            "country": country,
+            "max": 10,
+            "apikey": GNEWS_API_KEY,
+            # "from": None,
+            # "to": None,
+        }  # unused: `q`
+
+
+@lru_cache(maxsize=None)
+def smart_headlines_agent():
+    """The agent behind SmartHeadlinesTool, built the first time the tool is used."""
+    return initialize_agent(
+        [HeadlinesTool()],
+        ChatOpenAI(temperature=0.03, model="gpt-4-0613"),
+        agent=AgentType.OPENAI_FUNCTIONS,
+        # memory=self.memory,
+        verbose=os.environ.get("AGENT_C_VERBOSE", "") == "1",
+        # agent_kwargs=openai_kwargs,
+        # callbacks=[self.callback],
+    )
 
 
 class SmartHeadlinesTool(BaseTool):
@@ -83,19 +174,14 @@ class SmartHeadlinesTool(BaseTool):
     description: str = """Useful for when you need to fetch the top news headlines. \
         Returns the result in the form of a json string. \
         If you want to dive deeper into a particular news item, you can browse to the specified URL."""
-    agent = initialize_agent(
-            [HeadlinesTool()],
-            ChatOpenAI(temperature=0.03, model="gpt-4-0613"),
-            agent=AgentType.OPENAI_FUNCTIONS,
-            # memory=self.memory,
-            verbose=True,
-            # agent_kwargs=openai_kwargs,
-            # callbacks=[self.callback],
-        )
+
+    @property
+    def agent(self):
+        return smart_headlines_agent()
 
     async def _arun(self, query: str) -> str:
-        raise NotImplementedError
+        return await self.agent.arun(query)
+
     def _run(self, query: str) -> str:
         """Use the tool."""
-        raise NotImplementedError
-
+        return self.agent.run(query)
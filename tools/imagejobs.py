@@ -0,0 +1,224 @@
+import logging as log
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from tools.genimg import k_diffuser_model, replicate_api, sdxl_input
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Status, image URL and error of a prediction, as reported by a backend's `poll`.
+PollResult = Tuple[str, Optional[str], Optional[str]]
+
+
+class ReplicateBackend:
+    """Runs SDXL on Replicate through its predictions API, which returns straight away
+    with a prediction to poll, instead of blocking like `replicate.run`."""
+
+    def __init__(self, version: str = k_diffuser_model, timeout: float = 30):
+        self.version = version.split(":")[1]
+        self.timeout = timeout
+        self.http = requests.Session()
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Token {os.environ['REPLICATE_API_TOKEN']}"}
+
+    def create(self, prompt: str, negative_prompt: str = "") -> Dict[str, Any]:
+        response = self.http.post(
+            f"{replicate_api}/predictions",
+            json={"version": self.version, "input": sdxl_input(prompt, negative_prompt)},
+            headers=self._headers(),
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def poll(self, prediction: Dict[str, Any]) -> PollResult:
+        response = self.http.get(
+            prediction["urls"]["get"], headers=self._headers(), timeout=self.timeout
+        )
+        response.raise_for_status()
+        prediction = response.json()
+        output = prediction.get("output") or [None]
+        return prediction["status"], output[0], prediction.get("error")
+
+    def cancel(self, prediction: Dict[str, Any]):
+        self.http.post(prediction["urls"]["cancel"], headers=self._headers(), timeout=self.timeout)
+
+
+class FakeBackend:
+    """Local stand-in for tests and load tests: every image takes `seconds` to "generate"
+    and is always the same URL."""
+
+    def __init__(self, seconds: float = None, url: str = None):
+        self.seconds = float(os.environ.get("GENIMG_FAKE_SECONDS", "5")) if seconds is None else seconds
+        self.url = url or os.environ.get("GENIMG_FAKE_URL", "https://placehold.co/1024x1024.png")
+
+    def create(self, prompt: str, negative_prompt: str = "") -> Dict[str, Any]:
+        return {"ready_at": time.monotonic() + self.seconds}
+
+    def poll(self, prediction: Dict[str, Any]) -> PollResult:
+        if time.monotonic() < prediction["ready_at"]:
+            return "processing", None, None
+        return "succeeded", self.url, None
+
+    def cancel(self, prediction: Dict[str, Any]):
+        pass
+
+
+BACKENDS = {"replicate": ReplicateBackend, "fake": FakeBackend}
+
+
+class Job:
+    def __init__(self, owner, prompt, negative_prompt, curate, deliver, variants=1):
+        self.id = uuid.uuid4().hex[:8]
+        self.owner = owner
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.curate = curate
+        self.deliver = deliver
+        self.variants = variants
+        self.status = "queued"
+        self.cancelled = threading.Event()
+        self.future = None
+
+
+class ImageJobs:
+    """Generates images in the background, at most `workers` at a time.
+
+    `submit` returns a job at once; when the image is ready its URL is passed to the
+    job's `deliver` function (which sends it to Signal), and failures are reported the
+    same way. `cancel` drops an owner's queued jobs and cancels its running predictions.
+    Owners are plain ids (the sender), so a job holds no reference to the session that
+    started it."""
+
+    def __init__(self, backend, workers: int = 2, poll_interval: float = 1.0, timeout: float = 300):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="genimg")
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, Job] = {}
+        self.counters = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0}
+        self.seconds = []
+
+    def submit(
+        self,
+        owner: str,
+        prompt: str,
+        deliver: Callable[[str], Any],
+        negative_prompt: str = "",
+        curate: Optional[Callable[[str], str]] = None,
+        variants: int = 1,
+    ) -> Job:
+        """Queue an image of `prompt` for `owner`. With `curate`, the prompt is first
+        rewritten by it (e.g. the LLM prompt chain), also in the background. With
+        `variants`, that many images are generated concurrently from the one prompt
+        and delivered together."""
+        job = Job(owner, prompt, negative_prompt, curate, deliver, variants)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.counters["submitted"] += 1
+        job.future = self.pool.submit(self._run, job)
+        log.info(f"Queued image job {job.id}: {prompt!r}")
+        return job
+
+    def cancel(self, owner: str) -> int:
+        """Cancel every unfinished job of `owner`, returning how many there were."""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.owner == owner]
+        for job in jobs:
+            job.cancelled.set()
+            if job.future.cancel():
+                self._finish(job, "cancelled")
+        return len(jobs)
+
+    def pending(self, owner: str = None) -> List[Job]:
+        with self.lock:
+            return [job for job in self.jobs.values() if owner is None or job.owner == owner]
+
+    def _run(self, job: Job):
+        started = time.monotonic()
+        try:
+            job.status = "running"
+            prompt = job.curate(job.prompt) if job.curate else job.prompt
+            if job.cancelled.is_set():
+                return self._finish(job, "cancelled")
+            # Variants share the (curated) prompt and differ only in their random seed.
+            pending = {}
+            try:
+                for i in range(job.variants):
+                    pending[i] = self.backend.create(prompt, job.negative_prompt)
+            except Exception:
+                self._cancel_predictions(pending.values())
+                raise
+            urls, errors = {}, []
+            deadline = time.monotonic() + self.timeout
+            while True:
+                for i, prediction in list(pending.items()):
+                    status, url, error = self.backend.poll(prediction)
+                    if status == "succeeded":
+                        urls[i] = url
+                    elif status in ("failed", "canceled"):
+                        errors.append(f"image generation {status}: {error}")
+                    else:
+                        continue
+                    del pending[i]
+                if not pending:
+                    break
+                if job.cancelled.is_set() or time.monotonic() > deadline:
+                    self._cancel_predictions(pending.values())
+                    if job.cancelled.is_set():
+                        return self._finish(job, "cancelled")
+                    errors += [f"image generation timed out after {self.timeout:.0f}s"] * len(pending)
+                    break
+                job.cancelled.wait(self.poll_interval)
+            if not urls:
+                raise RuntimeError(errors[0])
+            self._finish(job, "succeeded", time.monotonic() - started)
+            message = "\n".join(f"🖼️ {urls[i]}" for i in sorted(urls))
+            if errors:
+                message += f"\n({len(errors)} of {job.variants} variants failed: {errors[0]})"
+            job.deliver(message)
+        except Exception as e:
+            log.error(f"Image job {job.id} failed: {e}")
+            self._finish(job, "failed")
+            job.deliver(f"Sorry, I couldn't generate the image for {job.prompt!r}: {e}")
+
+    def _cancel_predictions(self, predictions):
+        for prediction in predictions:
+            try:
+                self.backend.cancel(prediction)
+            except Exception as e:
+                log.warning(f"Failed to cancel a prediction: {e}")
+
+    def _finish(self, job: Job, status: str, seconds: float = None):
+        job.status = status
+        log.info(f"Image job {job.id} {status}.")
+        with self.lock:
+            if self.jobs.pop(job.id, None) is None:
+                return
+            self.counters[status] += 1
+            if seconds is not None:
+                self.seconds = self.seconds[-999:] + [seconds]
+
+    def stats(self) -> dict:
+        with self.lock:
+            seconds = sorted(self.seconds)
+            return {
+                **self.counters,
+                "pending": len(self.jobs),
+                "seconds_avg": sum(seconds) / len(seconds) if seconds else 0.0,
+                "seconds_max": seconds[-1] if seconds else 0.0,
+            }
+
+
+jobs = ImageJobs(
+    BACKENDS[os.environ.get("GENIMG_BACKEND", "replicate")](),
+    workers=int(os.environ.get("GENIMG_CONCURRENCY", "2")),
+)
@@ -1,25 +1,205 @@
-from typing import Type
+import asyncio
+import html
+import logging as log
+import os
+import re
+import threading
+import time
+from concurrent.futures import (
+    Future,
+    InvalidStateError,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    TimeoutError,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Type
 
+import aiohttp
+import requests
 import trafilatura
+from requests.adapters import HTTPAdapter
 from langchain.tools.base import BaseTool
 from pydantic import BaseModel, Field
 
-MAX_RESULT_LENGTH_CHAR = 1000 * 4 * 4  # roughly 4,000 tokens
+from tools import aio, budget
+from tools.cache import DEFAULT_DB, TTLCache
 
 
-def page_result(text: str, cursor: int, max_length: int) -> str:
-    """Page through `text` and return a substring of `max_length` characters starting from `cursor`."""
-    return text[cursor : cursor + max_length]
+# trafilatura's extraction is CPU-bound lxml work, so it runs in a process pool to keep
+# it off the GIL that concurrent agent turns share. 0 workers extracts inline.
+EXTRACT_WORKERS = int(os.environ.get("READER_EXTRACT_WORKERS", "2"))
+EXTRACT_TIMEOUT = float(os.environ.get("READER_EXTRACT_TIMEOUT", "10"))
+MAX_HTML_CHARS = int(os.environ.get("READER_MAX_HTML_MB", "5")) * 2**20
 
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
 
-def get_url(url: str) -> str:
-    """Fetch URL and return the contents as a string."""
-    downloaded = trafilatura.fetch_url(url)
-    if downloaded is None:
-        raise ValueError("Could not download article.")
+FETCH_TIMEOUT = float(os.environ.get("READER_FETCH_TIMEOUT", "20"))
+
+http = requests.Session()
+http.headers["User-Agent"] = aio.USER_AGENT
+http.mount("http://", HTTPAdapter(pool_maxsize=16))
+http.mount("https://", HTTPAdapter(pool_maxsize=16))
+readers = ThreadPoolExecutor(max_workers=8, thread_name_prefix="reader")
+
+# Extracted page text, shared by every session, so paging through an article (or two
+# users reading the same one) downloads and parses it only once.
+page_cache = TTLCache(
+    "pages",
+    ttl=float(os.environ.get("READER_CACHE_TTL", "3600")),
+    max_items=64,
+    path=DEFAULT_DB,
+)
+
+
+def extract(downloaded: str) -> str:
     return trafilatura.extract(downloaded, include_links=True, include_tables=True)
 
 
+def extract_text_only(downloaded: str) -> str:
+    """Cheap fallback extractor: strip scripts, styles and tags, keep the text."""
+    text = re.sub(r"(?is)<(script|style|noscript|head)\b.*?</\1>", " ", downloaded)
+    text = re.sub(r"(?s)<[^>]*>", " ", text)
+    text = html.unescape(text)
+    return re.sub(r"\s*\n\s*", "\n", re.sub(r"[ \t\r\f\v]+", " ", text)).strip()
+
+
+def extract_pool():
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None and EXTRACT_WORKERS > 0:
+            _extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+        return _extract_pool
+
+
+def extract_html(downloaded: str, timeout: float = EXTRACT_TIMEOUT) -> str:
+    """Extract the main text of an HTML document in the extraction process pool.
+
+    Oversized documents, and documents that take longer than `timeout` seconds, fall
+    back to `extract_text_only`. A timeout also restarts the pool, killing its workers:
+    extractions other turns have in flight fall back to text-only too, which is the
+    price of never leaving a worker stuck on a pathological page."""
+    if len(downloaded) > MAX_HTML_CHARS:
+        log.warning(f"HTML is {len(downloaded)} chars, using text-only extraction.")
+        return extract_text_only(downloaded[:MAX_HTML_CHARS])
+    pool = extract_pool()
+    if pool is None:
+        return extract(downloaded)
+    try:
+        return pool.submit(extract, downloaded).result(timeout=timeout)
+    except TimeoutError:
+        log.warning(f"Extraction timed out after {timeout}s, using text-only extraction.")
+        # The worker would otherwise keep parsing, holding a slot of the pool for good.
+        reset_extract_pool(pool, "timed out")
+    except BrokenProcessPool:
+        reset_extract_pool(pool)
+    return extract_text_only(downloaded)
+
+
+async def aextract_html(downloaded: str, timeout: float = EXTRACT_TIMEOUT) -> str:
+    """Async counterpart of `extract_html`."""
+    if len(downloaded) > MAX_HTML_CHARS:
+        log.warning(f"HTML is {len(downloaded)} chars, using text-only extraction.")
+        return extract_text_only(downloaded[:MAX_HTML_CHARS])
+    pool = extract_pool()
+    if pool is None:
+        return await asyncio.to_thread(extract, downloaded)
+    try:
+        return await asyncio.wait_for(
+            asyncio.wrap_future(pool.submit(extract, downloaded)), timeout
+        )
+    except asyncio.TimeoutError:
+        log.warning(f"Extraction timed out after {timeout}s, using text-only extraction.")
+        reset_extract_pool(pool, "timed out")
+    except BrokenProcessPool:
+        reset_extract_pool(pool)
+    return extract_text_only(downloaded)
+
+
+def terminate_pool(pool: ProcessPoolExecutor):
+    """Shut `pool` down and kill its workers, including any stuck on a task. Other
+    tasks still running in it fail with BrokenProcessPool."""
+    # There's no public handle on the workers before Python 3.14's terminate_workers.
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def reset_extract_pool(pool, reason: str = "broke"):
+    global _extract_pool
+    log.error(f"Extraction pool {reason}, restarting it.")
+    with _extract_pool_lock:
+        if _extract_pool is pool:
+            _extract_pool = None
+    terminate_pool(pool)
+
+
+def fetch_html(url: str, timeout: float = FETCH_TIMEOUT) -> str:
+    """Download `url` over the shared keep-alive session, giving up after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    with http.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        chunks, size = [], 0
+        for chunk in response.iter_content(chunk_size=2**16):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > MAX_HTML_CHARS:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out downloading {url}.")
+        encoding = response.encoding or response.apparent_encoding or "utf-8"
+    return b"".join(chunks).decode(encoding, errors="replace")
+
+
+def get_url(url: str, timeout: float = FETCH_TIMEOUT) -> str:
+    """Fetch URL and return the contents as a string."""
+
+    def download_and_extract():
+        downloaded = fetch_html(url, timeout)
+        if not downloaded:
+            raise ValueError("Could not download article.")
+        text = extract_html(downloaded, timeout=min(timeout, EXTRACT_TIMEOUT))
+        if text is None:
+            raise ValueError("Could not extract article.")
+        return text
+
+    return page_cache.get_or_compute(url, download_and_extract)
+
+
+async def afetch_html(url: str, timeout: float = FETCH_TIMEOUT) -> str:
+    """Async counterpart of `fetch_html`, over the shared aiohttp session."""
+    async with aio.session().get(
+        url, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as response:
+        response.raise_for_status()
+        chunks, size = [], 0
+        async for chunk in response.content.iter_chunked(2**16):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > MAX_HTML_CHARS:
+                break
+        encoding = response.get_encoding()
+    return b"".join(chunks).decode(encoding, errors="replace")
+
+
+async def aget_url(url: str, timeout: float = FETCH_TIMEOUT) -> str:
+    """Async counterpart of `get_url`, sharing its cache."""
+
+    async def download_and_extract():
+        downloaded = await afetch_html(url, timeout)
+        if not downloaded:
+            raise ValueError("Could not download article.")
+        text = await aextract_html(downloaded, timeout=min(timeout, EXTRACT_TIMEOUT))
+        if text is None:
+            raise ValueError("Could not extract article.")
+        return text
+
+    return await page_cache.aget_or_compute(url, download_and_extract)
+
+
 class SimpleReaderToolInput(BaseModel):
     url: str = Field(..., description="URL of the website to read")
 
@@ -32,23 +212,18 @@ class SimpleReaderTool(BaseTool):
     description: str = "Use this tool to fetch the contents of a webpage."
 
     def _run(self, url: str) -> str:
-        page_contents = get_url(url)
-
-        if len(page_contents) > MAX_RESULT_LENGTH_CHAR:
-            return page_result(page_contents, 0, MAX_RESULT_LENGTH_CHAR)
-
-        return page_contents
+        return budget.page(get_url(url))
 
     async def _arun(self, url: str) -> str:
-        raise NotImplementedError
+        return budget.page(await aget_url(url))
 
 
 class ReaderToolInput(BaseModel):
     url: str = Field(..., description="URL of the website to read")
     cursor: int = Field(
         default=0,
-        description="Start reading from this character."
-        "Use when the first response was truncated"
+        description="Start reading from this character. "
+        "Use when the first response was truncated "
         "and you want to continue reading the page.",
     )
 
@@ -61,13 +236,111 @@ class ReaderTool(BaseTool):
     description: str = "Use this tool to fetch the contents of a webpage."
 
     def _run(self, url: str, cursor: int = 0) -> str:
-        page_contents = get_url(url)
+        return budget.page(get_url(url), cursor)
 
-        if len(page_contents) > MAX_RESULT_LENGTH_CHAR:
-            page_contents = page_result(page_contents, cursor, MAX_RESULT_LENGTH_CHAR)
-            page_contents += f"\nPAGE WAS TRUNCATED. TO CONTINUE READING, USE CURSOR={cursor+len(page_contents)}."
+    async def _arun(self, url: str, cursor: int = 0) -> str:
+        return budget.page(await aget_url(url), cursor)
 
-        return page_contents
 
-    async def _arun(self, url: str) -> str:
-        raise NotImplementedError
+def settle(future: Future, value=None, error: Exception = None):
+    """Resolve `future` unless something else (a read or its deadline) got there first."""
+    try:
+        future.set_exception(error) if error is not None else future.set_result(value)
+    except InvalidStateError:
+        pass
+
+
+def read_urls(urls: List[str], timeout: float = FETCH_TIMEOUT) -> List[tuple]:
+    """Fetch and extract `urls` concurrently, each within `timeout` seconds.
+
+    A URL's `timeout` starts when a reader picks it up, so time spent queued behind
+    other sessions' reads in the shared pool doesn't count against it. Returns
+    `(url, text, error)` tuples in the order given; `text` is None on failure."""
+    expired = TimeoutError()
+
+    def read(url, result):
+        deadline = threading.Timer(timeout, settle, (result, None, expired))
+        deadline.daemon = True
+        deadline.start()
+        try:
+            settle(result, get_url(url, timeout))
+        except Exception as e:
+            settle(result, error=e)
+        finally:
+            deadline.cancel()
+
+    futures = [Future() for _ in urls]
+    for url, future in zip(urls, futures):
+        readers.submit(read, url, future)
+    wait(futures)
+    results = []
+    for url, future in zip(urls, futures):
+        if future.exception() is expired:
+            results.append((url, None, f"TIMED OUT after {timeout:.0f}s"))
+        elif future.exception() is not None:
+            results.append((url, None, f"FAILED: {future.exception()}"))
+        else:
+            results.append((url, future.result(), None))
+    return results
+
+
+async def aread_urls(urls: List[str], timeout: float = FETCH_TIMEOUT) -> List[tuple]:
+    """Async counterpart of `read_urls`."""
+    texts = await asyncio.gather(
+        *(asyncio.wait_for(aget_url(url, timeout), timeout) for url in urls),
+        return_exceptions=True,
+    )
+    results = []
+    for url, text in zip(urls, texts):
+        if isinstance(text, asyncio.TimeoutError):
+            results.append((url, None, f"TIMED OUT after {timeout:.0f}s"))
+        elif isinstance(text, BaseException):  # CancelledError too
+            results.append((url, None, f"FAILED: {text}"))
+        else:
+            results.append((url, text, None))
+    return results
+
+
+def share_budget(lengths: List[int], total: int) -> List[int]:
+    """Split `total` tokens across documents: short ones keep their full length,
+    and what they leave over is shared evenly among the longer ones."""
+    shares = [0] * len(lengths)
+    remaining = total
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for position, i in enumerate(order):
+        shares[i] = min(lengths[i], remaining // (len(order) - position))
+        remaining -= shares[i]
+    return shares
+
+
+class BatchReaderToolInput(BaseModel):
+    urls: List[str] = Field(..., description="URLs of the websites to read")
+
+
+class BatchReaderTool(BaseTool):
+    """Browser tool for getting several webpages' contents in one step."""
+
+    name: str = "fetch_pages"
+    args_schema: Type[BaseModel] = BatchReaderToolInput
+    description: str = "Use this tool to fetch the contents of several webpages at once, \
+        for example the most promising search results. Long pages are shortened; use \
+        fetch_page with a cursor to continue reading one of them."
+    timeout: float = FETCH_TIMEOUT
+    max_tokens: int = budget.PAGE_TOKENS
+
+    def _run(self, urls: List[str]) -> str:
+        return self._combine(read_urls(list(dict.fromkeys(urls)), self.timeout))
+
+    async def _arun(self, urls: List[str]) -> str:
+        return self._combine(await aread_urls(list(dict.fromkeys(urls)), self.timeout))
+
+    def _combine(self, results: List[tuple]) -> str:
+        pages = [(url, text) for url, text, _ in results if text is not None]
+        shares = share_budget([budget.count(text) for _, text in pages], self.max_tokens)
+        sections = [
+            f"## {url}\n{budget.page(text, 0, share)}" for (url, text), share in zip(pages, shares)
+        ]
+        for url, _, error in results:
+            if error is not None:
+                sections.append(f"## {url}\n{error}")
+        return "\n\n".join(sections)
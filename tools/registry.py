@@ -0,0 +1,44 @@
+import importlib
+import logging as log
+import sys
+import time
+from types import ModuleType
+from typing import Any, Optional
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Tool name -> (module under tools/, class). The modules import heavy libraries
+# (trafilatura, numpy, youtube_transcript_api, ...), so they are only imported when
+# an agent first needs one of their tools, not when the server starts.
+TOOLS = {
+    "calculator": ("calc", "Calculator"),
+    "documents": ("documents", "DocumentsTool"),
+    "fetch_page": ("reader", "ReaderTool"),
+    "fetch_pages": ("reader", "BatchReaderTool"),
+    "research": ("research", "ResearchTool"),
+    "headlines": ("gnews", "HeadlinesTool"),
+    "smart_headlines": ("gnews", "SmartHeadlinesTool"),
+    "youtube_transcript": ("ytsubs", "YoutubeTranscriptTool"),
+}
+
+
+def module(name: str) -> ModuleType:
+    """`tools.<name>`, imported on first use."""
+    qualified = f"tools.{name}"
+    if qualified in sys.modules:
+        return sys.modules[qualified]
+    started = time.monotonic()
+    loaded_module = importlib.import_module(qualified)
+    log.info(f"Imported {qualified} in {time.monotonic() - started:.2f}s.")
+    return loaded_module
+
+
+def loaded(name: str) -> Optional[ModuleType]:
+    """`tools.<name>` if something has imported it already, without importing it."""
+    return sys.modules.get(f"tools.{name}")
+
+
+def create(tool: str, **kwargs: Any) -> Any:
+    """A new instance of the tool registered as `tool`."""
+    module_name, cls = TOOLS[tool]
+    return getattr(module(module_name), cls)(**kwargs)
@@ -0,0 +1,135 @@
+import asyncio
+import math
+import re
+from collections import Counter
+from typing import Any, Callable, List, Type
+
+from langchain.tools.base import BaseTool
+from pydantic import BaseModel, Field
+
+from tools import budget
+from tools.reader import aread_urls, read_urls
+
+PASSAGE_LENGTH_CHAR = 800
+STOPWORDS = set(
+    "a an and are as at be by for from has have how in is it its of on or that the this \
+    to was were what when where which who why will with".split()
+)
+
+
+def terms(text: str) -> List[str]:
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOPWORDS]
+
+
+def split_passages(text: str, max_length: int = PASSAGE_LENGTH_CHAR) -> List[str]:
+    """Split text into passages of whole paragraphs, roughly `max_length` characters each."""
+    passages, current = [], ""
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) > max_length:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+
+def rank_passages(query: str, passages: List[Any], text: Callable = lambda p: p) -> List[Any]:
+    """Order `passages` by Okapi BM25 relevance to `query`, most relevant first.
+    `text` maps a passage to its text, for callers that rank richer objects."""
+    query_terms = set(terms(query))
+    documents = [Counter(terms(text(p))) for p in passages]
+    if not documents or not query_terms:
+        return list(passages)
+    average_length = sum(sum(d.values()) for d in documents) / len(documents) or 1
+    document_frequency = Counter(t for d in documents for t in query_terms if t in d)
+    k1, b = 1.5, 0.75
+
+    def score(document):
+        length = sum(document.values())
+        total = 0.0
+        for term in query_terms:
+            if term not in document:
+                continue
+            n = document_frequency[term]
+            idf = math.log(1 + (len(documents) - n + 0.5) / (n + 0.5))
+            tf = document[term]
+            total += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+        return total
+
+    scores = [score(d) for d in documents]
+    order = sorted(range(len(passages)), key=lambda i: -scores[i])
+    return [passages[i] for i in order if scores[i] > 0]
+
+
+class ResearchToolInput(BaseModel):
+    query: str = Field(..., description="The question or topic to research")
+
+
+class ResearchTool(BaseTool):
+    """Searches the web, reads the top results in parallel and returns the most relevant passages."""
+
+    name: str = "research"
+    args_schema: Type[BaseModel] = ResearchToolInput
+    description: str = "Useful for researching a question on the internet in one step. It \
+        searches the web, reads the top results and returns the passages most relevant to \
+        the query, each tagged with its source URL. Prefer this over Search followed by \
+        fetch_page when you need facts from web pages rather than just links."
+    search: Callable  # query -> list of {"title", "link", "snippet"} dicts
+    top_k: int = 4
+    max_tokens: int = budget.PAGE_TOKENS
+
+    def _run(self, query: str) -> str:
+        results = [r for r in self.search(query) if "link" in r]
+        if not results:
+            return "No search results found."
+        pages = read_urls([r["link"] for r in results[: self.top_k]])
+        return self._digest(query, results, pages)
+
+    async def _arun(self, query: str) -> str:
+        # The Google search client is synchronous.
+        results = [r for r in await asyncio.to_thread(self.search, query) if "link" in r]
+        if not results:
+            return "No search results found."
+        pages = await aread_urls([r["link"] for r in results[: self.top_k]])
+        return self._digest(query, results, pages)
+
+    def _digest(self, query: str, results: List[dict], pages: List[tuple]) -> str:
+        sources, passages = [], []
+        for url, text, error in pages:
+            if text is None:
+                continue
+            sources.append(url)
+            passages += [(len(sources), p) for p in split_passages(text)]
+        ranked = rank_passages(query, passages, text=lambda p: p[1])
+
+        digest, tokens = [], 0
+        for source, passage in ranked:
+            size = budget.count(passage)
+            if tokens + size > self.max_tokens:
+                continue
+            digest.append(f"[{source}] {passage}")
+            tokens += size
+
+        sections = []
+        if digest:
+            sections.append("Most relevant passages:\n\n" + "\n\n".join(digest))
+        if sources:
+            sections.append(
+                "Sources:\n" + "\n".join(f"[{i}] {url}" for i, url in enumerate(sources, 1))
+            )
+        failed = [f"{url} ({error})" for url, text, error in pages if text is None]
+        if failed:
+            sections.append("Could not read: " + ", ".join(failed))
+        others = results[self.top_k :]
+        if others:
+            sections.append(
+                "Other results:\n"
+                + "\n".join(
+                    f"{r.get('title', '')} - {r['link']}: {r.get('snippet', '')}" for r in others
+                )
+            )
+        return "\n\n".join(sections)
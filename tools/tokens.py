@@ -0,0 +1,20 @@
+from functools import lru_cache
+
+import tiktoken
+
+DEFAULT_MODEL = "gpt-4-0613"
+
+
+@lru_cache(maxsize=None)
+def encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=1024)
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Number of tokens `text` takes up for `model`. Cached, since conversation
+    messages get counted again on every turn."""
+    return len(encoding(model).encode(text, disallowed_special=()))
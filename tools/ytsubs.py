@@ -1,8 +1,41 @@
 #! /usr/bin/python3
 
+import asyncio
+import bisect
+import logging as log
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Type
+
+from langchain import LLMChain, PromptTemplate
+from langchain.schema.language_model import BaseLanguageModel
+from langchain.tools.base import BaseTool
+from pydantic import BaseModel, Field
 from youtube_transcript_api import YouTubeTranscriptApi
 
+from tools import budget
+
+log.basicConfig(level=log.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Transcripts are split into windows of this many seconds for reading; summaries use
+# windows twice as long, so an hour-long video takes six map calls.
+CHUNK_SECONDS = int(os.environ.get("YT_CHUNK_SECONDS", "300"))
+# How much of the transcript around a timestamp an "at" query returns.
+AT_WINDOW_SECONDS = int(os.environ.get("YT_AT_WINDOW_SECONDS", "90"))
+SUMMARY_CONCURRENCY = int(os.environ.get("YT_SUMMARY_CONCURRENCY", "4"))
+
+summarizers = ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY, thread_name_prefix="yt-summary")
+
+map_prompt = PromptTemplate.from_template(
+    "Summarize this part ({window}) of a YouTube video transcript in a few sentences. "
+    "Keep names, numbers and claims.\n\n{text}\n\nSUMMARY:"
+)
+reduce_prompt = PromptTemplate.from_template(
+    "Below are summaries of consecutive parts of a YouTube video, with their time ranges. "
+    "Write a concise overall summary of the video.\n\n{text}\n\nOVERALL SUMMARY:"
+)
+
 
 def extract_video_id(url):
     """
@@ -32,11 +65,179 @@ def extract_video_id(url):
     return None
 
 
-def yt_transcript(url: str) -> str:
-    """Function to fetch the transcript of a YouTube video, given the URL."""
-    video_id = extract_video_id(url)
-    if video_id:
-        transcript = YouTubeTranscriptApi.get_transcript(video_id)
-        if transcript:
-            return " ".join(f"[{segment['start']:.2f}] {segment['text']}" for segment in transcript)
-    return "Unable to fetch transcript."
+def timestamp(seconds: float) -> str:
+    """34:05, or 1:02:03 for videos over an hour."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+def parse_timestamp(value: str) -> float:
+    """Seconds into the video for "34:00", "1:02:03", "2040" or "2040s"."""
+    seconds = 0.0
+    for part in value.strip().rstrip("s").split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def get_segments(video_id: str) -> List[list]:
+    """The video's transcript as `[start, text]` pairs in order, cached per video so
+    paging, time-range queries and summaries never download it again."""
+
+    def fetch():
+        log.info(f"Fetching transcript for video {video_id}.")
+        return [
+            [snippet.start, snippet.text] for snippet in YouTubeTranscriptApi().fetch(video_id)
+        ]
+
+    return budget.documents.get_or_compute(f"youtube-segments|{video_id}", fetch)
+
+
+async def aget_segments(video_id: str) -> List[list]:
+    """Async version of `get_segments`. youtube_transcript_api only has a blocking client,
+    so the download runs on the default executor."""
+    return await asyncio.to_thread(get_segments, video_id)
+
+
+def chunk_segments(segments: List[list], seconds: int = CHUNK_SECONDS) -> List[tuple]:
+    """Group segments into `(start, end, text)` windows of `seconds` each."""
+    chunks = []
+    for start, text in segments:
+        window = int(start // seconds)
+        if not chunks or chunks[-1][0] != window:
+            chunks.append((window, []))
+        chunks[-1][1].append(f"[{timestamp(start)}] {text}")
+    return [
+        (window * seconds, (window + 1) * seconds, " ".join(lines)) for window, lines in chunks
+    ]
+
+
+def time_range(start: float, end: float) -> str:
+    return f"{timestamp(start)}-{timestamp(end)}"
+
+
+def render_chunks(chunks: List[tuple]) -> str:
+    return "\n\n".join(f"## {time_range(start, end)}\n{text}" for start, end, text in chunks)
+
+
+def segments_at(segments: List[list], at: float, window: int = AT_WINDOW_SECONDS) -> str:
+    """What was said within `window` seconds of `at`."""
+    starts = [start for start, _ in segments]
+    lo = bisect.bisect_left(starts, at - window)
+    hi = bisect.bisect_right(starts, at + window)
+    return " ".join(f"[{timestamp(start)}] {text}" for start, text in segments[lo:hi])
+
+
+class TranscriptInput(BaseModel):
+    url: str = Field(..., description="URL of the YouTube video")
+    mode: str = Field(
+        default="read",
+        description="'read' for the transcript itself, in 5 minute sections; 'summary' for "
+        "a summary of the whole video and of each section; 'at' for what was said around "
+        "the time given in `at`.",
+    )
+    at: Optional[str] = Field(
+        default=None,
+        description="Time in the video for mode 'at', like 34:00 or 1:02:03.",
+    )
+    cursor: int = Field(
+        default=0,
+        description="Start reading the result from this character. "
+        "Use when the first response was truncated and you want to continue reading.",
+    )
+
+
+class YoutubeTranscriptTool(BaseTool):
+    """Reads, summarizes or looks up a point in a YouTube video's transcript.
+
+    Summaries are map-reduce: `llm` summarizes each `summary_seconds` window of the
+    transcript concurrently, then combines those into an overview. Like the transcript
+    itself, the summary is cached per video."""
+
+    name: str = "YoutubeTranscriptFetcher"
+    args_schema: Type[BaseModel] = TranscriptInput
+    description: str = "Useful for when you need to fetch the transcript of a YouTube video \
+        to understand it better, find something in it, or to explain it to the user. For long \
+        videos, get the summary first, then look up what was said at specific times."
+    llm: BaseLanguageModel
+    summary_seconds: int = 2 * CHUNK_SECONDS
+
+    def _run(
+        self, url: str, mode: str = "read", at: Optional[str] = None, cursor: int = 0
+    ) -> str:
+        video_id = extract_video_id(url)
+        if not video_id:
+            return "Unable to fetch transcript: not a YouTube URL."
+        segments = get_segments(video_id)
+        if not segments:
+            return "Unable to fetch transcript."
+        if mode == "summary":
+            summary = budget.documents.get_or_compute(
+                f"youtube-summary|{video_id}", lambda: self._summarize(segments)
+            )
+            return budget.page(summary, cursor)
+        return self._lookup(segments, mode, at, cursor)
+
+    async def _arun(
+        self, url: str, mode: str = "read", at: Optional[str] = None, cursor: int = 0
+    ) -> str:
+        video_id = extract_video_id(url)
+        if not video_id:
+            return "Unable to fetch transcript: not a YouTube URL."
+        segments = await aget_segments(video_id)
+        if not segments:
+            return "Unable to fetch transcript."
+        if mode == "summary":
+            summary = await budget.documents.aget_or_compute(
+                f"youtube-summary|{video_id}", lambda: self._asummarize(segments)
+            )
+            return budget.page(summary, cursor)
+        return self._lookup(segments, mode, at, cursor)
+
+    def _lookup(self, segments: List[list], mode: str, at: Optional[str], cursor: int) -> str:
+        if mode != "at":
+            return budget.page(render_chunks(chunk_segments(segments)), cursor)
+        try:
+            seconds = parse_timestamp(at or "")
+        except ValueError:
+            return f"Could not understand the time {at!r}, use a format like 34:00."
+        found = segments_at(segments, seconds)
+        return budget.page(found, cursor) if found else f"Nothing was said around {at}."
+
+    def _summarize(self, segments: List[list]) -> str:
+        chunks = chunk_segments(segments, self.summary_seconds)
+        log.info(f"Summarizing a transcript in {len(chunks)} parts.")
+        chain = LLMChain(llm=self.llm, prompt=map_prompt)
+        futures = [
+            summarizers.submit(chain.predict, window=time_range(start, end), text=text)
+            for start, end, text in chunks
+        ]
+        outline = self._outline(chunks, [future.result() for future in futures])
+        if len(chunks) == 1:
+            return outline
+        overview = LLMChain(llm=self.llm, prompt=reduce_prompt).predict(text=outline)
+        return f"Overview: {overview.strip()}\n\nBy section:\n{outline}"
+
+    async def _asummarize(self, segments: List[list]) -> str:
+        chunks = chunk_segments(segments, self.summary_seconds)
+        log.info(f"Summarizing a transcript in {len(chunks)} parts.")
+        chain = LLMChain(llm=self.llm, prompt=map_prompt)
+        limit = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+        async def summarize(start, end, text):
+            async with limit:
+                return await chain.apredict(window=time_range(start, end), text=text)
+
+        outline = self._outline(
+            chunks, await asyncio.gather(*(summarize(*chunk) for chunk in chunks))
+        )
+        if len(chunks) == 1:
+            return outline
+        overview = await LLMChain(llm=self.llm, prompt=reduce_prompt).apredict(text=outline)
+        return f"Overview: {overview.strip()}\n\nBy section:\n{outline}"
+
+    def _outline(self, chunks: List[tuple], summaries: List[str]) -> str:
+        return "\n".join(
+            f"[{time_range(start, end)}] {summary.strip()}"
+            for (start, end, _), summary in zip(chunks, summaries)
+        )